@@ -28,137 +28,261 @@ Class for representing BED files
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import re
+import numpy as np
+import pandas as pd
+
+# Region strings such as chr5:1,200,001-3,400,000, with 1-based inclusive coordinates as in IGV and samtools
+REGION_PATTERN = re.compile(r'^(.+):([0-9,]+)-([0-9,]+)$')
+
+
 class BedFile():
-    ''' Parse bed file to get (amongst other things) composition of chromosomes in terms of features'''
-    def __init__(self, bed_file):
-        self.chromosomes = set()
+    ''' Parse bed file to get (amongst other things) composition of chromosomes in terms of features.
+    The records of each chromosome are kept in NumPy arrays of start and end coordinates and of feature and colour codes,
+    which are indices of the feature_names and colours lookup tables.
+    Records overlapping a region are found with binary searches in an index of the records of each chromosome sorted by start coordinate,
+    which is built at the first query of the chromosome'''
+    def __init__(self, bed_file=None):
+        self.chromosomes = list() # Chromosome names in the order of their first record
+        self.feature_names = list()
+        self.colours = list()
+        self.starts = dict() # dicts of chromosome of arrays with one value per record
+        self.ends = dict()
+        self.feature_codes = dict()
+        self.colour_codes = dict()
         self.all_features = set()
-        self.features = dict() # dict of chromosome of start positions of list (end, feature_type, color)
         self.chr_lengths = dict()
         self.features_per_chromosome = dict() # Count of the total number of features per chromosome to allow exclusion of chromosomes with too few features for windowing
+        self.interval_index = dict() # dict of chromosome of record order by start coordinate, sorted starts, ends in that order and running maximum of these ends
 
-        b = open(bed_file)
-        for x in b.readlines():
+        if bed_file is None:
+            return
         #tarseq_0_pilon  0       5000    set_5   0       +       0       5000    #E76BF3
-            x = x.rstrip()
-            if x.startswith('#'):
-                continue
-            v = x.split('\t')
-            self.chromosomes.add(v[0])
-            self.all_features.add(v[3])
-            if v[0] not in self.features:
-                self.features[v[0]] = dict()
-            if v[1] not in self.features[v[0]]:
-                self.features[v[0]][v[1]] = list()
-            self.features[v[0]][v[1]] = [v[2], v[3], v[8]]
+        # The number of columns is taken from the first record, as comment lines have a different number of columns
+        n_columns = None
+        with open(bed_file) as b:
+            for x in b:
+                if not x.startswith('#'):
+                    n_columns = len(x.rstrip().split('\t'))
+                    break
+        if n_columns is None:
+            return
+        bed_df = pd.read_csv(bed_file, sep='\t', header=None, names=list(range(n_columns)), usecols=[0, 1, 2, 3, 8], dtype=str, keep_default_na=False)
+        bed_df = bed_df[~bed_df[0].str.startswith('#')]
+        self.set_records(bed_df[0].to_numpy(), bed_df[1].to_numpy(dtype=np.int64), bed_df[2].to_numpy(dtype=np.int64), bed_df[3].to_numpy(), bed_df[8].to_numpy())
 
-            # Record chromosome length i.e. rightmost feature end (which is not guaranteed to be the chromosome end!)
-            if v[0] not in self.chr_lengths:
-                self.chr_lengths[v[0]] = int(v[2])
-            elif self.chr_lengths[v[0]] < int(v[2]):
-                self.chr_lengths[v[0]] = int(v[2])
+    @classmethod
+    def from_clusters(cls, data, cluster_colours):
+        ''' Make a BedFile from a data frame of clustered windows (chromosome, start, end and cluster columns), with the same contents as parsing
+        the clusters.bed file written from that data frame'''
+        bed_data = cls()
+        bed_data.set_records(data['chromosome'].astype(str).to_numpy(), data['start'].to_numpy(dtype=np.int64), data['end'].to_numpy(dtype=np.int64) + 1,
+                             data['cluster'].astype(str).to_numpy(), data['cluster'].map(cluster_colours).to_numpy())
+        return(bed_data)
+
+    def set_records(self, chromosomes, starts, ends, features, colours):
+        ''' Store BED records given as arrays of chromosome names, start and end coordinates, feature names and colours (one element per record).
+        As when a BED file is parsed line by line, a record replaces the earlier record of the chromosome with the same start coordinate,
+        but the replaced record still counts towards the chromosome length and the number of features of the chromosome'''
+        (chromosome_codes, self.chromosomes) = pd.factorize(chromosomes)
+        self.chromosomes = self.chromosomes.tolist()
+        (feature_codes, self.feature_names) = pd.factorize(features)
+        self.feature_names = self.feature_names.tolist()
+        (colour_codes, self.colours) = pd.factorize(colours)
+        self.colours = self.colours.tolist()
+        self.all_features = set(self.feature_names)
+        self.interval_index = dict()
+        code_dtype = np.int16 if max(len(self.feature_names), len(self.colours)) <= np.iinfo(np.int16).max else np.int32
 
+        record_order = np.argsort(chromosome_codes, kind='stable')
+        chromosome_starts = np.cumsum(np.bincount(chromosome_codes, minlength=len(self.chromosomes)))[:-1]
+        for (chromosome, records) in zip(self.chromosomes, np.split(record_order, chromosome_starts)):
+            # Record chromosome length i.e. rightmost feature end (which is not guaranteed to be the chromosome end!)
+            self.chr_lengths[chromosome] = int(ends[records].max())
             # Record number of features per chromosome
-            if v[0] not in self.features_per_chromosome:
-                self.features_per_chromosome[v[0]] = 0
-            self.features_per_chromosome[v[0]] = self.features_per_chromosome[v[0]] + 1
+            self.features_per_chromosome[chromosome] = len(records)
 
-        b.close()
+            (unique_starts, first_records, record_starts) = np.unique(starts[records], return_index=True, return_inverse=True)
+            if len(unique_starts) < len(records):
+                # The values of the last record with each start coordinate are kept, in the position of the first record with that start coordinate
+                last_records = np.zeros(len(unique_starts), dtype=np.int64)
+                np.maximum.at(last_records, record_starts, np.arange(len(records)))
+                records = records[last_records[np.argsort(first_records)]]
+            self.starts[chromosome] = starts[records]
+            self.ends[chromosome] = ends[records]
+            self.feature_codes[chromosome] = feature_codes[records].astype(code_dtype)
+            self.colour_codes[chromosome] = colour_codes[records].astype(code_dtype)
 
     def circos_json(self):
         json_dict = dict()
         json_dict['genome'] = list()
-        for c in self.chr_lengths:
+        for c in self.chromosomes:
             json_dict['genome'].append({'id': c, 'label': c, 'color': 'red', 'len': self.chr_lengths[c]})
         json_dict['clusters'] = list()
-        for c in self.features:
-            for s in self.features[c]:
-                json_dict['clusters'].append({'name': c + str(s), 'block_id': c, 'start': s, 'end': self.features[c][s][0], 'cluster': self.features[c][s][1], 'color': self.features[c][s][2]})
+        for c in self.chromosomes:
+            features = [self.feature_names[x] for x in self.feature_codes[c].tolist()]
+            colours = [self.colours[x] for x in self.colour_codes[c].tolist()]
+            json_dict['clusters'].extend([{'name': c + s, 'block_id': c, 'start': s, 'end': e, 'cluster': f, 'color': col}
+                                          for (s, e, f, col) in zip(map(str, self.starts[c].tolist()), map(str, self.ends[c].tolist()), features, colours)])
         return(json_dict)
 
     def chromosome_composition(self):
-        sum = dict()
-        total = dict()
-        for c in self.features:
-            for s in self.features[c]:
-                if c not in sum:
-                    sum[c] = dict()
-                if self.features[c][s][1] not in sum[c]:
-                    sum[c][self.features[c][s][1]] = 0
-                sum[c][self.features[c][s][1]] = sum[c][self.features[c][s][1]] + (int(self.features[c][s][0]) - int(s) + 1)
-                if c not in total:
-                    total[c] = 0
-                total[c] = total[c] + (int(self.features[c][s][0]) - int(s) + 1)
-
         comp_res = dict()
+        for c in self.chromosomes:
+            feature_lengths = self.ends[c] - self.starts[c] + 1
+            feature_sums = np.bincount(self.feature_codes[c], weights=feature_lengths, minlength=len(self.feature_names))
+            total = feature_sums.sum()
+            comp_res[c] = dict()
+            # Features in the order of their first record in the chromosome
+            for f in pd.unique(self.feature_codes[c]):
+                comp_res[c][self.feature_names[f]] = float(feature_sums[f] / total)
+        return comp_res
 
-        for c in sum:
-            for f in sum[c]:
-                if c not in comp_res:
-                    comp_res[c] = dict()
-                freq = (sum[c][f] / total[c])
-                comp_res[c][f] = freq
+    def get_interval_index(self, chromosome):
+        ''' Returns the interval index of a chromosome: the order of its records by start coordinate, the sorted start coordinates,
+        the end coordinates in the same order and their running maximum. The index is built at the first call for the chromosome '''
+        if chromosome not in self.interval_index:
+            record_order = np.argsort(self.starts[chromosome], kind='stable')
+            sorted_ends = self.ends[chromosome][record_order]
+            self.interval_index[chromosome] = (record_order, self.starts[chromosome][record_order], sorted_ends, np.maximum.accumulate(sorted_ends))
+        return self.interval_index[chromosome]
 
-        return comp_res
+    def query_record_indices(self, chromosome, starts, ends):
+        ''' Returns a list with an array for each of the regions of one chromosome given by the starts and ends arrays (0-based, end-exclusive as in BED),
+        with the indices of the records of the chromosome that overlap the region, in the order of their start coordinates.
+        Records that end at or before the region start are skipped with a binary search in the running maximum of the record ends, so for records that do not
+        contain each other (e.g. windows) a query takes O(log n + k) time for k overlapping records. Records inside a longer record that ends after the region start are
+        checked one by one '''
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if chromosome not in self.starts:
+            return [np.zeros(0, dtype=np.int64) for x in starts]
+        (record_order, sorted_starts, sorted_ends, max_ends) = self.get_interval_index(chromosome)
+        first_candidates = np.searchsorted(max_ends, starts, side='right')
+        last_candidates = np.maximum(first_candidates, np.searchsorted(sorted_starts, ends, side='left'))
+        # Candidate records of all regions as one array: the positions first_candidates[i] ... last_candidates[i] - 1 of each region i in the sorted records
+        n_candidates = last_candidates - first_candidates
+        region_offsets = np.cumsum(n_candidates) - n_candidates
+        candidates = np.arange(n_candidates.sum()) - np.repeat(region_offsets - first_candidates, n_candidates)
+        candidate_regions = np.repeat(np.arange(len(starts)), n_candidates)
+        is_overlapping = sorted_ends[candidates] > starts[candidate_regions]
+        n_overlapping = np.bincount(candidate_regions[is_overlapping], minlength=len(starts))
+        return np.split(record_order[candidates[is_overlapping]], np.cumsum(n_overlapping)[:-1])
+
+    def get_records(self, chromosome, record_indices):
+        ''' Returns a list of (start, end, feature, colour) tuples of the records of a chromosome with the given indices '''
+        return [(s, e, self.feature_names[f], self.colours[col]) for (s, e, f, col) in zip(self.starts[chromosome][record_indices].tolist(), self.ends[chromosome][record_indices].tolist(),
+                                                                                          self.feature_codes[chromosome][record_indices].tolist(), self.colour_codes[chromosome][record_indices].tolist())]
+
+    def query(self, chromosome, start, end):
+        ''' Returns a list of (start, end, feature, colour) tuples of the records that overlap the region from start to end of a chromosome
+        (0-based, end-exclusive as in BED), sorted by start coordinate. Returns an empty list for chromosomes without records '''
+        if chromosome not in self.starts:
+            return list()
+        return self.get_records(chromosome, self.query_record_indices(chromosome, [start], [end])[0])
+
+    def query_many(self, regions):
+        ''' Returns a list with the query results of each region, where regions is a list of (chromosome, start, end) tuples or region strings (see parse_region).
+        The regions of each chromosome are queried together '''
+        regions = [self.get_region_bounds(region) for region in regions]
+        results = [list() for region in regions]
+        regions_df = pd.DataFrame(regions, columns=['chromosome', 'start', 'end'])
+        for (chromosome, chromosome_regions) in regions_df.groupby('chromosome', sort=False):
+            if chromosome not in self.starts:
+                continue
+            record_indices_list = self.query_record_indices(chromosome, chromosome_regions['start'].to_numpy(), chromosome_regions['end'].to_numpy())
+            for (i, record_indices) in zip(chromosome_regions.index, record_indices_list):
+                results[i] = self.get_records(chromosome, record_indices)
+        return results
+
+    def coverage_by_cluster(self, region):
+        ''' Returns a dict where keys are features (clusters) and values are the numbers of bases of the region that are covered by records of that feature,
+        in the order of the first record of each feature in the region. The region is a (chromosome, start, end) tuple or a region string (see parse_region) '''
+        (chromosome, start, end) = self.get_region_bounds(region)
+        if chromosome not in self.starts:
+            return dict()
+        record_indices = self.query_record_indices(chromosome, [start], [end])[0]
+        covered_lengths = np.minimum(self.ends[chromosome][record_indices], end) - np.maximum(self.starts[chromosome][record_indices], start)
+        feature_codes = self.feature_codes[chromosome][record_indices]
+        feature_coverage = np.bincount(feature_codes, weights=covered_lengths, minlength=len(self.feature_names))
+        return {self.feature_names[f]: int(feature_coverage[f]) for f in pd.unique(feature_codes)}
+
+    def get_region_bounds(self, region):
+        ''' Returns a (chromosome, start, end) tuple of a region given as a tuple or a region string (see parse_region).
+        A region string without coordinates covers the whole chromosome, up to the rightmost record end '''
+        if isinstance(region, str):
+            region = parse_region(region)
+        (chromosome, start, end) = region
+        if start is None:
+            start = 0
+        if end is None:
+            end = self.chr_lengths.get(chromosome, 0)
+        return (chromosome, int(start), int(end))
 
     def cluster_histograms(self, windows = 100):
         ''' Generate data describing frequency of each cluster over each chromosome in N windows
         This will be used for comparing patterns of each cluster over different chromosomes '''
+        return self.multi_cluster_histograms([windows])[windows]
+
+    def multi_cluster_histograms(self, window_numbers):
+        ''' Returns a dict where keys are numbers of windows and values are the cluster histograms with that number of windows, as returned by cluster_histograms.
+        The records of each chromosome are sorted once for all numbers of windows '''
 
         # n.b. here feature means cluster feature i.e. -1, 0, 1, 2, etc.
-        feat_patterns = dict() # Dict of clusters, of dict of chromosomes of list of values per window
+        feat_patterns_dict = {windows: dict() for windows in window_numbers} # Dicts of clusters, of dict of chromosomes of list of values per window
+        feature_codes = {f: i for (i, f) in enumerate(self.feature_names)}
 
-        for c in self.features:
-            # Exclude chromosomes with fewer features than we are looking at windows
-            if c in self.features_per_chromosome and self.features_per_chromosome[c] < windows:
-                continue
+        for c in self.chromosomes:
+            record_order = np.argsort(self.starts[c], kind='stable')
+            sorted_starts = self.starts[c][record_order]
+            sorted_feature_codes = self.feature_codes[c][record_order]
+
+            for windows in window_numbers:
+                # Exclude chromosomes with fewer features than we are looking at windows
+                if self.features_per_chromosome[c] < windows:
+                    continue
+                (record_windows, n_windows) = get_record_windows(sorted_starts, self.chr_lengths[c], windows)
+                is_counted = record_windows >= 0
+                win_counts = np.bincount(record_windows[is_counted] * len(self.feature_names) + sorted_feature_codes[is_counted], minlength=n_windows * len(self.feature_names))
+                win_counts = win_counts.reshape(n_windows, len(self.feature_names))
+                total_win_feat = win_counts.sum(axis=1)
+                freqs = win_counts / np.maximum(total_win_feat, 1)[:, np.newaxis]
+                empty_windows = np.flatnonzero(total_win_feat == 0).tolist()
+
+                feat_patterns = feat_patterns_dict[windows]
+                for f in self.all_features:
+                    if f not in feat_patterns:
+                        feat_patterns[f] = dict()
+                    feat_patterns[f][c] = freqs[:, feature_codes[f]].tolist()
+                    # The frequency of a cluster in a window without features is an integer 0
+                    for i in empty_windows:
+                        feat_patterns[f][c][i] = 0
+
+        return feat_patterns_dict
+
+
+def get_record_windows(sorted_starts, chr_length, windows):
+    ''' Returns the window number of each record of a chromosome (records sorted by start coordinate) in the cluster histograms with the given number of windows,
+    or -1 for records that are not counted in any window, and the number of windows of the chromosome.
+    Windows are assigned as when walking through the records: the window end is moved forward by one window length at the first record that starts
+    after the current window end, and that record is not counted. The window number of a record is therefore the number of windows moved before it,
+    k(i + 1) = min(k(i) + 1, w(i)), where w(i) is the number of window ends before the start of record i. This recurrence is solved for all records at once
+    as k(i + 1) = i + min(1, min(w(j) - j for j <= i)) '''
+    win_length = chr_length / windows
+    # Window ends are running sums of the window length, as in the walk. Record starts are below the chromosome length, so they are before the last window end
+    window_ends = np.cumsum(np.full(int(np.ceil(windows)) + 2, win_length))
+    ends_before_start = np.searchsorted(window_ends, sorted_starts, side='left')
+    record_numbers = np.arange(len(sorted_starts))
+    windows_after_record = record_numbers + np.minimum(1, np.minimum.accumulate(ends_before_start - record_numbers))
+    windows_before_record = np.concatenate([[0], windows_after_record[:-1]])
+    record_windows = np.where(windows_after_record == windows_before_record, windows_before_record, -1)
+    return (record_windows, int(windows_after_record[-1]) + 1)
 
-            win_length = self.chr_lengths[c] / windows
-            win_end = win_length
-            win_num = 0
-            win_counts = dict()
-            total_win_feat = 0
-
-
-            for s in sorted([int(x) for x in self.features[c]]):
-                s = str(s)
-                end = self.features[c][s][0]
-                feat = self.features[c][s][1]
-                if int(s) > win_end:
-
-                    for f in self.all_features:
-                        if f not in win_counts:
-                            win_counts[f] = 0
-                        freq = 0
-                        if total_win_feat > 0:
-                            freq = win_counts[f] / total_win_feat
-                        if f not in feat_patterns:
-                            feat_patterns[f] = dict()
-                        if c not in feat_patterns[f]:
-                            feat_patterns[f][c] = list()
-                        feat_patterns[f][c].append(freq)
-
-                    win_num = win_num + 1
-                    win_end = win_end + win_length
-                    win_counts = dict()
-                    total_win_feat = 0
-                else:
-                    if feat not in win_counts:
-                        win_counts[feat] = 0
-                    win_counts[feat] = win_counts[feat] + 1
-                    total_win_feat = total_win_feat + 1
-            # Clean up final window
-            for f in self.all_features:
-                if f not in win_counts:
-                    win_counts[f] = 0
-                freq = 0
-                if total_win_feat > 0:
-                    freq = win_counts[f] / total_win_feat
-                if f not in feat_patterns:
-                    feat_patterns[f] = dict()
-                if c not in feat_patterns[f]:
-                    feat_patterns[f][c] = list()
-                feat_patterns[f][c].append(freq)
-
-        return feat_patterns
 
+def parse_region(region_string):
+    ''' Returns a (chromosome, start, end) tuple of a region string like chr5:1,200,001-3,400,000 (1-based, inclusive as in IGV and samtools), with 0-based,
+    end-exclusive coordinates as in BED. A string that is not in this format is taken as a chromosome name, with start and end None '''
+    region_match = REGION_PATTERN.match(region_string)
+    if region_match is None:
+        return (region_string, None, None)
+    return (region_match.group(1), int(region_match.group(2).replace(',', '')) - 1, int(region_match.group(3).replace(',', '')))
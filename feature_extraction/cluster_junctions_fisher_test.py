@@ -30,6 +30,7 @@ Fisher test is used to determine if some types of cluster junctions occur more r
 # SOFTWARE.
 
 from collections import OrderedDict
+import gzip
 import pandas as pd
 import numpy as np
 import scipy.stats as stats
@@ -138,10 +139,14 @@ def cluster_junctions_fisher_test(observed_counts_dict, expected_counts_dict):
 
 def load_clusters_dict(bed_file_path):
     """
-    Loads cluster positions information from BED file
+    Loads cluster positions information from BED file. Files with the .gz extension (clusters.bed.gz written with the --bgzip option of gda clustering) are decompressed
     """
     clusters_dict = OrderedDict()
-    bed_data = gpf.l(bed_file_path)
+    if bed_file_path.endswith(".gz"):
+        with gzip.open(bed_file_path, "rt") as f:
+            bed_data = [x.rstrip() for x in f]
+    else:
+        bed_data = gpf.l(bed_file_path)
     for line in bed_data:
         split_line = line.split()
         scaff = split_line[0]
@@ -167,10 +172,11 @@ def condense_counts_dict(input_dict, cluster_pairs_condensed):
     return condensed_dict
 
 
-def main(bed_file_path, out_folder):
-    gpf.run_system_command("mkdir -p {}".format(out_folder))
-    clusters_dict = load_clusters_dict(bed_file_path)
-
+def get_cluster_junctions_table(clusters_dict):
+    """
+    Input: dictionary where keys are scaffold names and values are lists of the clusters of consecutive windows of the scaffold
+    Output: dataframe with observed and expected counts of each type of cluster junction, Fisher test results and fold differences
+    """
     clusters_list = list(clusters_dict.values())
     clusters_list = [item for sublist in clusters_list for item in sublist] # Flattening a list of lists
 
@@ -195,14 +201,20 @@ def main(bed_file_path, out_folder):
     fisher_df = cluster_junctions_fisher_test(observed_counts_dict2, expected_counts_dict2)
     fisher_df["observed_vs_expected_fold_diff"] = fisher_df["observed"] / fisher_df["expected_int"]
     fisher_df["log2_observed_vs_expected_fold_diff"] = np.log2(fisher_df["observed_vs_expected_fold_diff"])
+    return fisher_df
+
 
+def main(bed_file_path, out_folder):
+    gpf.run_system_command("mkdir -p {}".format(out_folder))
+    clusters_dict = load_clusters_dict(bed_file_path)
+    fisher_df = get_cluster_junctions_table(clusters_dict)
     fisher_out_path = out_folder + "/cluster_junctions_fisher_test.csv"
     fisher_df.to_csv(fisher_out_path)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("bed_file_path", type=str, help="Path to the input clusters.bed file")
+    parser.add_argument("bed_file_path", type=str, help="Path to the input clusters.bed file (or clusters.bed.gz)")
     parser.add_argument("out_folder", type=str, help="Folder path for output CSV file")
     args = parser.parse_args()
     main(args.bed_file_path, args.out_folder)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the clustering stage of GDA on synthetic data.
+Synthetic merged tracks tables with planted clusters are generated for each of the requested numbers of windows,
+and the run time and memory use of UMAP, HDBSCAN, the feature enrichment tests, the binned feature histograms and the output writers
+are saved to a JSON file, so that the performance of different versions of GDA can be compared
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import numpy as np
+import pandas as pd
+import umap
+import hdbscan
+from sklearn.metrics import adjusted_rand_score
+
+from gda_clustering import run_umap, run_hdbscan, binned_feature_histograms, get_cluster_cols_dict, write_embedding, write_cluster_gff, write_cluster_bed
+from gda_enrichment import get_significant_features, KS_MODES
+from gda_profiling import RunProfiler
+
+BENCHMARK_STAGES = ('umap', 'hdbscan', 'enrichment', 'histograms', 'writers')
+
+
+def make_synthetic_tracks(n_windows, n_features=20, n_species=2, n_clusters=8, n_chromosomes=10, window_size=5000, mean_segment_windows=50, random_state=123):
+    '''Returns a synthetic merged tracks data frame and the planted cluster label of each window.
+    The windows of each species are spread over n_chromosomes chromosomes. Each chromosome is made of segments of consecutive windows
+    that belong to one of n_clusters planted clusters, and the feature values of a window are drawn around the feature means of its cluster'''
+    rng = np.random.RandomState(random_state)
+    cluster_means = rng.uniform(0, 100, size=(n_clusters, n_features))
+    cluster_sds = rng.uniform(1, 10, size=(n_clusters, n_features))
+
+    # Planted clusters as segments of consecutive windows with geometrically distributed lengths
+    planted_labels = np.repeat(rng.randint(0, n_clusters, size=n_windows), rng.geometric(1 / mean_segment_windows, size=n_windows))[:n_windows]
+    feature_values = cluster_means[planted_labels] + rng.standard_normal((n_windows, n_features)) * cluster_sds[planted_labels]
+
+    species_codes = np.arange(n_windows) * n_species // n_windows
+    chromosome_codes = (np.arange(n_windows) - np.searchsorted(species_codes, species_codes)) * n_chromosomes // np.bincount(species_codes)[species_codes]
+    species = np.char.add('species_', species_codes.astype(str))
+    chromosomes = np.char.add(np.char.add(species, '_chr'), chromosome_codes.astype(str))
+    is_chromosome_start = np.r_[True, (chromosomes[1:] != chromosomes[:-1])]
+    chromosome_start_indices = np.flatnonzero(is_chromosome_start)
+    window_numbers = np.arange(n_windows) - np.repeat(chromosome_start_indices, np.diff(np.r_[chromosome_start_indices, n_windows]))
+    starts = window_numbers * window_size
+
+    data = pd.DataFrame({'start': starts, 'end': starts + window_size - 1, 'species': species.astype(object), 'chromosome': chromosomes.astype(object)})
+    for i in range(n_features):
+        data['feature_' + str(i)] = feature_values[:, i]
+    data.index = pd.Index(np.char.add(np.char.add(chromosomes, '_'), starts.astype(str)).astype(object), name='window')
+    return(data, planted_labels)
+
+
+def make_synthetic_embedding(planted_labels, random_state=123):
+    '''Returns a 2D embedding with one Gaussian blob per planted cluster, used in place of the UMAP embedding when UMAP is not benchmarked'''
+    rng = np.random.RandomState(random_state)
+    n_clusters = planted_labels.max() + 1
+    centres = rng.uniform(-20, 20, size=(n_clusters, 2))
+    return (centres[planted_labels] + rng.standard_normal((len(planted_labels), 2))).astype(np.float32)
+
+
+def run_benchmark(n_windows, n_features, n_species, n_clusters, stages, n_neighbors, min_cluster_size, pvalue_cutoff, ks_mode, workers, outdir):
+    '''Run the selected stages on one synthetic table, returns a dict of the stage measurements'''
+    sys.stderr.write("Benchmarking {} windows\n".format(n_windows))
+    profiler = RunProfiler()
+    with profiler.stage("synthetic data"):
+        (data, planted_labels) = make_synthetic_tracks(n_windows, n_features, n_species, n_clusters)
+    data_to_cluster = data.drop(['species', 'start', 'end', 'chromosome'], axis=1)
+
+    if 'umap' in stages:
+        with profiler.stage("umap"):
+            embedding = run_umap(data_to_cluster, n_neighbors)
+    else:
+        embedding = make_synthetic_embedding(planted_labels)
+
+    result = {'n_windows': n_windows, 'n_features': n_features, 'n_species': n_species, 'n_planted_clusters': n_clusters}
+    if 'hdbscan' in stages:
+        with profiler.stage("hdbscan"):
+            cluster_labels = run_hdbscan(embedding, 40, None, min_cluster_size=min_cluster_size)
+        result['n_clusters_found'] = int(cluster_labels.max() + 1)
+        result['planted_clusters_adjusted_rand_index'] = adjusted_rand_score(planted_labels, cluster_labels)
+    else:
+        cluster_labels = planted_labels
+    data['cluster'] = cluster_labels
+    cluster_colours = get_cluster_cols_dict(int(max(cluster_labels)))
+
+    sig_features = [f for f in data_to_cluster.columns]
+    if 'enrichment' in stages:
+        with profiler.stage("enrichment"):
+            sig_features = get_significant_features(data, pvalue_cutoff, workers=workers, ks_mode=ks_mode)[0]
+    if 'histograms' in stages:
+        with profiler.stage("histograms"):
+            binned_feature_histograms(data, sig_features)
+    if 'writers' in stages:
+        writers_outdir = tempfile.mkdtemp(dir=outdir)
+        with profiler.stage("write_embedding"):
+            write_embedding(embedding, cluster_labels, data['species'].tolist(), 'umap_clustering.csv', writers_outdir, cluster_colours)
+        with profiler.stage("write_cluster_gff"):
+            write_cluster_gff(data, writers_outdir)
+        with profiler.stage("write_cluster_bed"):
+            write_cluster_bed(data, cluster_colours, writers_outdir)
+        shutil.rmtree(writers_outdir)
+    result['stages'] = profiler.stages
+    return result
+
+
+def get_environment_info():
+    '''Returns the versions of Python and the main libraries used by the clustering stage'''
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'umap': umap.__version__, 'hdbscan': getattr(hdbscan, '__version__', 'unknown')}
+
+
+def main(sizes, n_features, n_species, n_clusters, stages, n_neighbors, min_cluster_size, pvalue_cutoff, ks_mode, workers, outfile):
+    outdir = os.path.dirname(os.path.abspath(outfile))
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    benchmark = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'environment': get_environment_info(),
+                 'parameters': {'stages': stages, 'n_neighbors': n_neighbors, 'min_cluster_size': min_cluster_size, 'pvalue_cutoff': pvalue_cutoff, 'ks_mode': ks_mode, 'workers': workers},
+                 'results': list()}
+    for n_windows in sizes:
+        benchmark['results'].append(run_benchmark(n_windows, n_features, n_species, n_clusters, stages, n_neighbors, min_cluster_size, pvalue_cutoff, ks_mode, workers, outdir))
+        # The results are saved after each table size, so that the smaller sizes are kept if a large one runs out of time or memory
+        with open(outfile, 'w') as f:
+            f.write(json.dumps(benchmark, indent=1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", help="Comma separated numbers of windows of the synthetic tables (default: 10000,100000,1000000)", default="10000,100000,1000000", type=str)
+    parser.add_argument("--features", help="Number of features (default: 20)", default=20, type=int)
+    parser.add_argument("--species", help="Number of species (default: 2)", default=2, type=int)
+    parser.add_argument("--clusters", help="Number of planted clusters (default: 8)", default=8, type=int)
+    parser.add_argument("--stages", help="Comma separated stages to benchmark, out of {}. If UMAP is not benchmarked, a synthetic embedding is clustered, and if HDBSCAN is not benchmarked, the planted clusters are used (default: all stages)".format(",".join(BENCHMARK_STAGES)), default=",".join(BENCHMARK_STAGES), type=str)
+    parser.add_argument("-n", "--n_neighbors", help="N neighbours argument for UMAP [13]", default=13, type=int)
+    parser.add_argument("-c", "--cluster_size_cutoff", help="HDBSCAN min cluster size [200]", default=200, type=int)
+    parser.add_argument("-p", "--pvalue_cutoff", help="p-value cutoff for feature enrichment in clusters [1e-20]", default=1e-20, type=float)
+    parser.add_argument("--ks_mode", help="Method for calculating Kolmogorov-Smirnov test p-values of feature enrichment (default: exact)", default="exact", choices=KS_MODES, type=str)
+    parser.add_argument("--workers", help="Number of worker processes for the feature enrichment tests (default: 1)", default=1, type=int)
+    parser.add_argument("-o", "--outfile", help="Output JSON file [gda_benchmark.json]", default="gda_benchmark.json", type=str)
+    args = parser.parse_args()
+    stages = args.stages.split(",")
+    unknown_stages = [x for x in stages if x not in BENCHMARK_STAGES]
+    if len(unknown_stages) > 0:
+        sys.stderr.write("Unknown benchmark stage(s): {}\n".format(", ".join(unknown_stages)))
+        sys.exit(1)
+    sizes = [int(x) for x in args.sizes.split(",")]
+    main(sizes, args.features, args.species, args.clusters, stages, args.n_neighbors, args.cluster_size_cutoff, args.pvalue_cutoff, args.ks_mode, args.workers, args.outfile)
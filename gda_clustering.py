@@ -29,8 +29,16 @@ A script for turning GDA tracks into analysed clusters
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-# Several species-specific analyses are done based on BedFile objects
-from BedFile import BedFile
+# Species-specific analyses of the clusters
+from gda_species_analytics import get_species_analytics
+# Feature enrichment tests for the clusters
+from gda_enrichment import get_significant_features, KS_MODES
+# Cache of UMAP embeddings
+from gda_embedding_cache import EmbeddingCache
+# Reading of merged TSV and columnar tracks tables
+from gda_tracks_io import read_tracks_table
+# Timing and memory use of the stages of the run
+from gda_profiling import RunProfiler
 
 import sys
 import os
@@ -39,9 +47,15 @@ import numpy as np
 import pandas as pd
 import umap
 from sklearn.preprocessing import MinMaxScaler
+from sklearn.utils import check_random_state
+from sklearn.metrics import adjusted_rand_score
 import hdbscan
-from scipy.stats import ks_2samp
 import json
+import pickle
+import traceback
+import inspect
+from contextlib import contextmanager
+from multiprocessing import Pool
 import spectra
 
 # Ignore NUMBA warnings related to running UMAP
@@ -54,6 +68,21 @@ warnings.filterwarnings("ignore", category=NumbaPerformanceWarning)
 warnings.filterwarnings("ignore", category=NumbaDeprecationWarning)
 warnings.filterwarnings("ignore", category=NumbaWarning)
 
+# Number of rows of the BED, GFF and UMAP embedding outputs that are converted to text at a time
+OUTPUT_CHUNK_SIZE = 100000
+# Buffer size of the output files in bytes
+OUTPUT_BUFFER_SIZE = 4 * 1024 * 1024
+# UMAP computes exact nearest neighbours for datasets with fewer windows than this, so a precomputed nearest neighbour graph is not used for them
+UMAP_SMALL_DATA_SIZE = 4096
+# Number of bins of the feature histograms of each cluster
+FEATURE_HISTOGRAM_BINS = 50
+# Columns of the clustered windows that are used for the per-species outputs
+SPECIES_OUTPUT_COLUMNS = ['species', 'chromosome', 'start', 'end', 'cluster']
+# Per-species file with the window number of each cluster position histograms file
+CLUSTER_POSITION_FILES_FILENAME = 'clusterpos_files.json'
+# Default folder of the UMAP embedding cache in the output directory
+DEFAULT_EMBEDDING_CACHE_DIR = '.umap_embedding_cache'
+
 ###############
 # Functions
 ###############
@@ -79,124 +108,348 @@ def get_cluster_cols_dict(max_n):
     return colours_dict
 
 
-def run_umap(data, n_neighbors=13):
-    '''Scale feature values each from 0 to 1 and run UMAP, return 2D embedding'''
-    # Scale data 0->1
-    scalar = MinMaxScaler()
-    scalar.fit(data)
-    scaled_data = scalar.transform(data)
-    reducer = umap.UMAP(random_state=123, n_neighbors=n_neighbors, min_dist=0.1, n_components=2, metric='euclidean')
-    embedding = reducer.fit_transform(scaled_data)
+def fit_scaler(data, copy=True):
+    '''Returns a MinMaxScaler fitted to scale feature values each from 0 to 1. If copy is False and data is a float array, the scaler transforms it in place'''
+    scaler = MinMaxScaler(copy=copy)
+    scaler.fit(data)
+    return(scaler)
+
+
+def scale_data(data, copy=True):
+    '''Scale feature values each from 0 to 1. If copy is False and data is a float array, it is scaled in place'''
+    return(fit_scaler(data, copy=copy).transform(data))
+
+
+def get_feature_matrix(data, feature_columns):
+    '''Returns the values of the feature columns as a single C-contiguous float32 array, for scaling in place and passing to UMAP without further copies'''
+    feature_matrix = np.empty((len(data.index), len(feature_columns)), dtype=np.float32)
+    for i, f in enumerate(feature_columns):
+        feature_matrix[:, i] = data[f].to_numpy()
+    return feature_matrix
+
+
+def fit_umap_models(data, n_neighbors=13, min_dist=0.1, metric='euclidean', random_state=123, copy=True):
+    '''Fit the 0 to 1 scaling and UMAP to the data in the same way as scale_data and run_umap_on_scaled_data,
+    return the fitted scaler, the fitted UMAP reducer and the 2D embedding'''
+    scaler = fit_scaler(data, copy=copy)
+    scaled_data = scaler.transform(data)
+    (reducer, embedding) = fit_umap(scaled_data, n_neighbors, min_dist, metric, random_state)
+    return(scaler, reducer, embedding)
+
+
+def run_umap(data, n_neighbors=13, min_dist=0.1, metric='euclidean', random_state=123, embedding_cache=None, copy=True):
+    '''Scale feature values each from 0 to 1 and run UMAP, return 2D embedding.
+    If an EmbeddingCache is given, a cached embedding of the same scaled data and UMAP parameters is returned without running UMAP.
+    If copy is False and data is a float array, it is scaled in place'''
+    scaled_data = scale_data(data, copy=copy)
+    return(run_umap_on_scaled_data(scaled_data, n_neighbors, min_dist, metric, random_state, embedding_cache))
+
+
+def run_umap_on_scaled_data(scaled_data, n_neighbors=13, min_dist=0.1, metric='euclidean', random_state=123, embedding_cache=None, knn_graph=None):
+    '''Run UMAP on feature values that have been scaled from 0 to 1, return 2D embedding. The embedding cache is used as in run_umap.
+    If a NearestNeighbourGraph with at least n_neighbors neighbours is given, UMAP uses its nearest neighbours instead of searching for them'''
+    cache_key = None
+    if embedding_cache is not None:
+        cache_key = get_umap_cache_key(embedding_cache, scaled_data, n_neighbors, min_dist, metric, random_state, knn_graph)
+        embedding = embedding_cache.load(cache_key)
+        if embedding is not None:
+            sys.stderr.write("Using cached UMAP embedding {}\n".format(embedding_cache.get_path(cache_key)))
+            return(embedding)
+    (reducer, embedding) = fit_umap(scaled_data, n_neighbors, min_dist, metric, random_state, knn_graph)
+    if embedding_cache is not None:
+        embedding_cache.store(cache_key, embedding)
     return(embedding)
 
 
-def run_hdbscan(embedding, leaf_size, min_samples, min_cluster_size=200):
-    '''Cluster UMAP embedding with HDBSCAN, return cluster labels'''
+def get_umap_reducer(n_neighbors=13, min_dist=0.1, metric='euclidean', random_state=123, **kwargs):
+    '''Returns an unfitted UMAP reducer with a 2D embedding. Other keyword arguments are passed to UMAP'''
+    return(umap.UMAP(random_state=random_state, n_neighbors=n_neighbors, min_dist=min_dist, n_components=2, metric=metric, **kwargs))
+
+
+def fit_umap(scaled_data, n_neighbors=13, min_dist=0.1, metric='euclidean', random_state=123, knn_graph=None):
+    '''Fit UMAP to feature values that have been scaled from 0 to 1, return the fitted UMAP reducer and the 2D embedding.
+    The nearest neighbour graph is used as in run_umap_on_scaled_data'''
+    if uses_knn_graph(scaled_data, knn_graph):
+        return(fit_umap_with_knn_graph(scaled_data, knn_graph, n_neighbors, min_dist, metric, random_state))
+    reducer = get_umap_reducer(n_neighbors, min_dist, metric, random_state)
+    embedding = reducer.fit_transform(scaled_data)
+    return(reducer, embedding)
+
+
+def uses_knn_graph(scaled_data, knn_graph):
+    '''Returns True if a UMAP run on the scaled data would use the precomputed nearest neighbour graph'''
+    return knn_graph is not None and len(scaled_data) >= UMAP_SMALL_DATA_SIZE
+
+
+def get_umap_cache_key(embedding_cache, scaled_data, n_neighbors=13, min_dist=0.1, metric='euclidean', random_state=123, knn_graph=None):
+    '''Returns the embedding cache key of a UMAP run on the scaled data'''
+    cache_params = {'n_neighbors': n_neighbors, 'min_dist': min_dist, 'metric': metric, 'random_state': random_state, 'n_components': 2, 'umap_version': umap.__version__}
+    if uses_knn_graph(scaled_data, knn_graph):
+        # The approximate nearest neighbours found at a larger n_neighbors can differ from those found at n_neighbors
+        cache_params['knn_n_neighbors'] = knn_graph.n_neighbors
+    return embedding_cache.get_key(scaled_data, **cache_params)
+
+
+class NearestNeighbourGraph():
+    ''' Approximate nearest neighbours of each window, found once at the largest n_neighbors of a parameter sweep (on first use) and shared by the UMAP fits with smaller n_neighbors'''
+    def __init__(self, scaled_data, n_neighbors, metric='euclidean', random_state=123):
+        self.scaled_data = scaled_data
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.random_state = random_state
+        self.knn = None
+
+    def get(self, n_neighbors):
+        '''Returns the indices and distances of the n_neighbors nearest neighbours of each window, and the search index'''
+        if n_neighbors > self.n_neighbors:
+            raise ValueError("The nearest neighbour graph has {} neighbours, but {} were requested".format(self.n_neighbors, n_neighbors))
+        if self.knn is None:
+            sys.stderr.write("Finding {} nearest neighbours of each window\n".format(self.n_neighbors))
+            self.knn = umap.umap_.nearest_neighbors(self.scaled_data, self.n_neighbors, self.metric, {}, False, check_random_state(self.random_state), low_memory=False, use_pynndescent=True)
+        (knn_indices, knn_dists, search_index) = self.knn
+        return(np.ascontiguousarray(knn_indices[:, :n_neighbors]), np.ascontiguousarray(knn_dists[:, :n_neighbors]), search_index)
+
+
+@contextmanager
+def precomputed_nearest_neighbours(knn_indices, knn_dists, search_index):
+    '''For UMAP versions without the precomputed_knn option (umap-learn < 0.5), makes UMAP.fit use the given nearest neighbours instead of searching for them'''
+    nearest_neighbors = umap.umap_.nearest_neighbors
+    def get_precomputed_nearest_neighbours(X, n_neighbors, *args, **kwargs):
+        return(knn_indices, knn_dists, search_index)
+    umap.umap_.nearest_neighbors = get_precomputed_nearest_neighbours
+    try:
+        yield
+    finally:
+        umap.umap_.nearest_neighbors = nearest_neighbors
+
+
+def fit_umap_with_knn_graph(scaled_data, knn_graph, n_neighbors=13, min_dist=0.1, metric='euclidean', random_state=123):
+    '''Run UMAP using the nearest neighbours of a NearestNeighbourGraph, return the fitted UMAP reducer and the 2D embedding'''
+    (knn_indices, knn_dists, search_index) = knn_graph.get(n_neighbors)
+    if 'precomputed_knn' in inspect.signature(umap.UMAP).parameters:
+        reducer = get_umap_reducer(n_neighbors, min_dist, metric, random_state, precomputed_knn=(knn_indices, knn_dists))
+        return(reducer, reducer.fit_transform(scaled_data))
+    reducer = get_umap_reducer(n_neighbors, min_dist, metric, random_state)
+    with precomputed_nearest_neighbours(knn_indices, knn_dists, search_index):
+        return(reducer, reducer.fit_transform(scaled_data))
+
+
+def get_embedding_cache(embedding_cache_dir, embedding_cache_size, outdir):
+    '''Returns an EmbeddingCache for the UMAP embeddings, or None if the cache size is 0.
+    By default the cache is in a hidden folder of the output directory, so that it is not taken for a species folder of the output'''
+    if embedding_cache_size <= 0:
+        return None
+    if embedding_cache_dir == '':
+        embedding_cache_dir = outdir + '/' + DEFAULT_EMBEDDING_CACHE_DIR
+    return EmbeddingCache(embedding_cache_dir, max_size_mb=embedding_cache_size)
+
+
+def fit_hdbscan(embedding, leaf_size, min_samples, min_cluster_size=200, prediction_data=False):
+    '''Cluster UMAP embedding with HDBSCAN, return the fitted clusterer. prediction_data=True is needed for assigning new points to the clusters later'''
     clusterer = hdbscan.HDBSCAN(algorithm='best', alpha=1.0, approx_min_span_tree=True,
         gen_min_span_tree=False, leaf_size=leaf_size,
-        metric='euclidean', min_cluster_size=min_cluster_size, min_samples=min_samples, p=None)
+        metric='euclidean', min_cluster_size=min_cluster_size, min_samples=min_samples, p=None, prediction_data=prediction_data)
     clusterer.fit(embedding)
+    return(clusterer)
+
+
+def run_hdbscan(embedding, leaf_size, min_samples, min_cluster_size=200):
+    '''Cluster UMAP embedding with HDBSCAN, return cluster labels'''
+    clusterer = fit_hdbscan(embedding, leaf_size, min_samples, min_cluster_size=min_cluster_size)
     return(clusterer.labels_)
 
 
-def write_cluster_bed(data, cluster_colours, outdir):
-    '''Write BED file describing clusters - return dict of species -> filename'''
-    # Declare list of filnames
-    clusters_bed_fn = ''
-    # Loop over species to make BED file for each
-    clusters_bed_fn = ('clusters.bed')
-    cb = open(outdir + '/' + clusters_bed_fn, 'w')
-    for row_tuple in data.iterrows():
-        row = row_tuple[1]
-        bed_string = '\t'.join([row.chromosome, str(row.start), str(row.end + 1), str(row.cluster), '0', '+', str(row.start), str(row.end + 1), cluster_colours[row.cluster]])
-        cb.write(bed_string + "\n")
-    cb.close()
+def run_hdbscan_sweep(embedding, leaf_size, min_samples, min_cluster_sizes):
+    '''Cluster UMAP embedding with HDBSCAN for each of the min cluster sizes, return a dict where keys are min cluster sizes and values are cluster labels.
+    The single linkage tree of the mutual reachability distances does not depend on min_cluster_size, so it is built once for each min_samples value
+    and the clusters of the other min cluster sizes are extracted from it. The labels are the same as with separate run_hdbscan runs'''
+    cluster_labels_dict = dict()
+    single_linkage_trees = dict()
+    for min_cluster_size in min_cluster_sizes:
+        # HDBSCAN uses min_cluster_size as min_samples if min_samples is not set, so the tree can only be reused if min_samples is set
+        tree_min_samples = min_samples if min_samples is not None else min_cluster_size
+        if tree_min_samples in single_linkage_trees:
+            cluster_labels_dict[min_cluster_size] = hdbscan.hdbscan_._tree_to_labels(embedding, single_linkage_trees[tree_min_samples], min_cluster_size=min_cluster_size)[0]
+        else:
+            clusterer = fit_hdbscan(embedding, leaf_size, tree_min_samples, min_cluster_size=min_cluster_size)
+            single_linkage_trees[tree_min_samples] = clusterer._single_linkage_tree
+            cluster_labels_dict[min_cluster_size] = clusterer.labels_
+    return cluster_labels_dict
+
+
+def save_models(models, outfile, outdir):
+    '''Save the fitted scaler, UMAP reducer and HDBSCAN clusterer (with their settings) for projecting new windows into the clustering'''
+    with open(outdir + '/' + outfile, 'wb') as f:
+        pickle.dump(models, f)
+
+
+def load_models(models_file):
+    '''Load the fitted models saved by save_models'''
+    if not os.path.isfile(models_file):
+        sys.stderr.write("Models file {} was not found\n".format(models_file))
+        sys.exit(1)
+    with open(models_file, 'rb') as f:
+        models = pickle.load(f)
+    return models
+
+
+def read_tracks(tracks_file, compact=False):
+    '''Read in GDA data tracks (merged TSV file or columnar tracks folder) as pandas data frame and remove any N-containing windows.
+    If compact is True, feature values are read as float32 and species and chromosome as categoricals'''
+    # GDA data tracks file format: window_name (unique), species, chromosome, start, end, feature_values (tab separated)
+    data = read_tracks_table(tracks_file, compact=compact)
+    filter_windows(data)
+    return data
+
+
+def filter_windows(data):
+    '''Remove any N-containing windows from the data frame in place'''
+    if 'N_percentage' in data.columns:
+        data.drop(index=data[data.N_percentage>0].index, axis=0, inplace=True)
+
+
+def select_landmarks(data, n_landmarks, random_state=123):
+    '''Select a subsample of about n_landmarks windows, stratified by species and chromosome. Returns a boolean array that is True for the landmark windows'''
+    rng = np.random.RandomState(random_state)
+    is_landmark = np.zeros(len(data.index), dtype=bool)
+    fraction = n_landmarks / len(data.index)
+    group_indices = data.groupby(['species', 'chromosome'], sort=True, observed=True).indices
+    for group in group_indices:
+        indices = group_indices[group]
+        # Each chromosome keeps at least one landmark
+        n = min(len(indices), max(1, int(round(len(indices) * fraction))))
+        is_landmark[rng.choice(indices, n, replace=False)] = True
+    return is_landmark
+
+
+def assign_to_clusters(scaled_data, indices, reducer, clusterer, batch_size):
+    '''Embed the windows at the given row indices with a fitted UMAP reducer and assign them to the clusters of a fitted HDBSCAN clusterer (fitted with prediction_data=True).
+    The windows are processed in batches of batch_size to limit memory use. Returns the embedding and the cluster labels'''
+    embedding = np.zeros((len(indices), 2), dtype=np.float32)
+    cluster_labels = np.zeros(len(indices), dtype=int)
+    for batch_start in range(0, len(indices), batch_size):
+        batch_end = min(batch_start + batch_size, len(indices))
+        batch_embedding = reducer.transform(scaled_data[indices[batch_start:batch_end]])
+        embedding[batch_start:batch_end] = batch_embedding
+        cluster_labels[batch_start:batch_end] = hdbscan.approximate_predict(clusterer, batch_embedding)[0]
+    return(embedding, cluster_labels)
+
+
+def get_subsample_min_cluster_size(min_cluster_size, n_sampled, n_windows):
+    '''Returns the HDBSCAN min cluster size for clustering a subsample of n_sampled windows out of n_windows, so that the smallest cluster
+    of the subsample stands for about min_cluster_size windows of the whole table. HDBSCAN needs a min cluster size of at least 2'''
+    return max(2, int(round(min_cluster_size * n_sampled / n_windows)))
+
+
+def get_landmark_agreement(scaled_data, is_landmark, landmark_labels, projected_labels, n_holdout, n_neighbors, leaf_size, min_samples, min_cluster_size, random_state=123):
+    '''Compare landmark clustering with a clustering of the landmarks plus a held-out sample of the other windows.
+    min_cluster_size is the min cluster size for the whole table, which is scaled to the number of landmark and held-out windows.
+    Returns a dict with the adjusted Rand index of the held-out windows (projected labels vs labels from the combined clustering) and of the landmarks'''
+    rng = np.random.RandomState(random_state)
+    other_indices = np.flatnonzero(~is_landmark)
+    holdout_indices = np.sort(rng.choice(other_indices, min(n_holdout, len(other_indices)), replace=False))
+    landmark_indices = np.flatnonzero(is_landmark)
+    combined_indices = np.concatenate([landmark_indices, holdout_indices])
+    (reducer, combined_embedding) = fit_umap(scaled_data[combined_indices], n_neighbors, random_state=random_state)
+    combined_labels = run_hdbscan(combined_embedding, leaf_size, min_samples, min_cluster_size=get_subsample_min_cluster_size(min_cluster_size, len(combined_indices), len(scaled_data)))
+    holdout_agreement = adjusted_rand_score(combined_labels[len(landmark_indices):], projected_labels[holdout_indices])
+    landmark_agreement = adjusted_rand_score(combined_labels[:len(landmark_indices)], landmark_labels)
+    return {'n_holdout_windows': int(len(holdout_indices)), 'holdout_adjusted_rand_index': float(holdout_agreement), 'landmark_adjusted_rand_index': float(landmark_agreement)}
+
+
+def run_landmark_clustering(data, data_to_cluster, n_landmarks, n_neighbors, leaf_size, min_samples, min_cluster_size, batch_size, n_holdout, copy=True):
+    '''Run UMAP and HDBSCAN on a stratified subsample of landmark windows and assign the remaining windows to the landmark clusters.
+    min_cluster_size is the min cluster size for the whole table: HDBSCAN is run on the landmarks with the min cluster size scaled by the fraction of windows that are landmarks.
+    Returns the fitted scaler, UMAP reducer and HDBSCAN clusterer, the embedding and cluster labels of all windows, and a report dict'''
+    scaler = fit_scaler(data_to_cluster, copy=copy)
+    scaled_data = scaler.transform(data_to_cluster)
+    is_landmark = select_landmarks(data, n_landmarks)
+    sys.stderr.write("Running UMAP on {} landmark windows out of {}\n".format(is_landmark.sum(), len(is_landmark)))
+    (reducer, landmark_embedding) = fit_umap(scaled_data[is_landmark], n_neighbors)
+    landmark_min_cluster_size = get_subsample_min_cluster_size(min_cluster_size, is_landmark.sum(), len(is_landmark))
+    sys.stderr.write("Running HDBSCAN on landmark windows with min cluster size {} (min cluster size {} scaled to the landmarks)\n".format(landmark_min_cluster_size, min_cluster_size))
+    clusterer = fit_hdbscan(landmark_embedding, leaf_size, min_samples, min_cluster_size=landmark_min_cluster_size, prediction_data=True)
+
+    sys.stderr.write("Assigning the other windows to landmark clusters\n")
+    embedding = np.zeros((len(is_landmark), 2), dtype=np.float32)
+    cluster_labels = np.zeros(len(is_landmark), dtype=int)
+    embedding[is_landmark] = landmark_embedding
+    cluster_labels[is_landmark] = clusterer.labels_
+    other_indices = np.flatnonzero(~is_landmark)
+    (embedding[other_indices], cluster_labels[other_indices]) = assign_to_clusters(scaled_data, other_indices, reducer, clusterer, batch_size)
+
+    report = {'n_windows': int(len(is_landmark)), 'n_landmarks': int(is_landmark.sum()), 'min_cluster_size': int(min_cluster_size), 'landmark_min_cluster_size': int(landmark_min_cluster_size)}
+    if n_holdout > 0 and is_landmark.sum() < len(is_landmark):
+        sys.stderr.write("Comparing landmark clustering with a clustering of landmarks and held-out windows\n")
+        report.update(get_landmark_agreement(scaled_data, is_landmark, clusterer.labels_, cluster_labels, n_holdout, n_neighbors, leaf_size, min_samples, min_cluster_size))
+        sys.stderr.write("Adjusted Rand index of held-out windows (projected vs clustered): {:.3f}\n".format(report['holdout_adjusted_rand_index']))
+    return(scaler, reducer, clusterer, embedding, cluster_labels, report)
+
+
+def open_output_file(path, compress=False):
+    '''Open a text output file for writing, as a bgzip-compressed file (with .gz added to the path) if compress is True'''
+    if compress:
+        # Biopython is only needed for compressed output
+        from Bio import bgzf
+        return bgzf.BgzfWriter(path + '.gz', 'w')
+    return open(path, 'w', buffering=OUTPUT_BUFFER_SIZE)
+
+
+def iter_chunks(n_rows, chunk_size=OUTPUT_CHUNK_SIZE):
+    '''Yield (start, end) row ranges of chunks of at most chunk_size rows'''
+    for chunk_start in range(0, n_rows, chunk_size):
+        yield(chunk_start, min(chunk_start + chunk_size, n_rows))
+
+
+def write_lines(line_chunks, path, header=None, compress=False):
+    '''Write chunks of text lines (pandas Series of strings without line ends) to a file'''
+    with open_output_file(path, compress) as f:
+        if header is not None:
+            f.write(header + '\n')
+        for lines in line_chunks:
+            if len(lines) > 0:
+                f.write('\n'.join(lines.tolist()) + '\n')
+
+
+def get_cluster_bed_lines(data, cluster_colours):
+    '''Yield chunks of clusters.bed lines, each built with vectorized string operations on the columns of the chunk'''
+    for (chunk_start, chunk_end) in iter_chunks(len(data.index)):
+        chunk = data.iloc[chunk_start:chunk_end]
+        start = chunk['start'].astype(str)
+        end = (chunk['end'] + 1).astype(str)
+        cluster = chunk['cluster']
+        yield(chunk['chromosome'].astype(str) + '\t' + start + '\t' + end + '\t' + cluster.astype(str) + '\t0\t+\t' + start + '\t' + end + '\t' + cluster.map(cluster_colours))
+
+
+def get_cluster_gff_lines(data):
+    '''Yield chunks of clusters.gff lines, each built with vectorized string operations on the columns of the chunk'''
+    for (chunk_start, chunk_end) in iter_chunks(len(data.index)):
+        chunk = data.iloc[chunk_start:chunk_end]
+        yield(chunk['chromosome'].astype(str) + '\tGDA\tregion\t' + (chunk['start'] + 1).astype(str) + '\t' + (chunk['end'] + 1).astype(str) + '\t.\t+\t.\tID=' + chunk['cluster'].astype(str) + ';colour=1')
+
+
+def get_embedding_lines(emb, cluster_labels, species, cluster_colours):
+    '''Yield chunks of umap_clustering.csv lines. The UMAP coordinates are converted to strings by NumPy, which gives the same shortest representation as str() of each value'''
+    cluster_labels = pd.Series(np.asarray(cluster_labels))
+    species = pd.Series(species, dtype=object).astype(str)
+    for (chunk_start, chunk_end) in iter_chunks(len(cluster_labels)):
+        umap1 = pd.Series(np.asarray(emb[chunk_start:chunk_end, 0]).astype(str), index=cluster_labels.index[chunk_start:chunk_end], dtype=object)
+        umap2 = pd.Series(np.asarray(emb[chunk_start:chunk_end, 1]).astype(str), index=umap1.index, dtype=object)
+        cluster = cluster_labels.iloc[chunk_start:chunk_end]
+        yield(umap1 + ',' + umap2 + ',' + species.iloc[chunk_start:chunk_end] + ',' + cluster.astype(str) + ',' + cluster.map(cluster_colours).astype(str))
+
+
+def write_cluster_bed(data, cluster_colours, outdir, compress=False):
+    '''Write BED file describing clusters - return the filename'''
+    clusters_bed_fn = 'clusters.bed'
+    write_lines(get_cluster_bed_lines(data, cluster_colours), outdir + '/' + clusters_bed_fn, compress=compress)
     return(clusters_bed_fn)
 
 
-def write_cluster_gff(data, outdir):
+def write_cluster_gff(data, outdir, compress=False):
     '''Write GFF of clusters'''
     clusters_gff_fn = 'clusters.gff'
-    cg = open(outdir + '/' + clusters_gff_fn, 'w')
-    for row_tuple in data.iterrows():
-        row = row_tuple[1]
-        start = row.start + 1
-        end = row.end + 1
-        gff_string = '\t'.join([row.chromosome, 'GDA', 'region', str(start), str(end), '.', '+', '.', 'ID='+str(row.cluster)+';colour=1'])
-        cg.write(gff_string + "\n")
-    cg.close()
-
-
-def get_significant_features(data, pvalue_cutoff):
-    '''Get significant features in each cluster and determine proportions of each cluster in each species'''
-    cluster_list = sorted(set(data['cluster'].tolist()))
-
-    # Make a dictionary of the data for ease of access
-    data_dict = data.to_dict()
-    cluster_dict = data_dict['cluster']
-
-    # Make a dictionary with cluster as key and a list of windows as the value
-    cluster_to_windows = dict()
-    for x in cluster_dict:
-        if cluster_dict[x] not in cluster_to_windows:
-            cluster_to_windows[cluster_dict[x]] = list()
-        cluster_to_windows[cluster_dict[x]].append(x)
-
-    # Record a set of significant features for returning
-    sig_features = set()
-    cluster_means = dict() # This is used for heatmap
-    cluster_genome_prop = dict() # Proportion of genome made up by cluster
-    # cluster proportions by species
-    cluster_species_genome_prop = dict()
-
-    species_list = sorted(set(data['species'].tolist()))
-
-    # Store signficant feature results for each cluster
-    cluster_results = dict()
-    cluster_results_df = pd.DataFrame(columns=['cluster', 'feature', 'cluster_data.size', 'other_data.size', 'stat_less', 'pvalue_less', 'stat_great', 'pvalue_great', 'cluster_median', 'other_median', 'cluster_mean', 'other_mean'])
-
-    for c in cluster_list:
-        cluster_data = data[data['cluster'] == c]
-        # Store proportion of genome made up of each cluster
-        cluster_genome_prop[c] = (cluster_data.size * 100) / (data.size)
-
-        # Determine proportion of cluster in each species' genomes
-        for s in species_list:
-            species_cluster_data = data[data.cluster.eq(c) & data.species.eq(s)]
-            if c not in cluster_species_genome_prop:
-                cluster_species_genome_prop[c] = dict()
-            cluster_species_genome_prop[c][s] = (species_cluster_data.size * 100) / (data[data.species.eq(s)].size)
-
-        for f in data.columns:
-            if f in ['species', 'cluster', 'start', 'end', 'chromosome']:
-                continue
-            # select values for this feature and this cluster
-            cluster_data = data[f][cluster_to_windows[c]]
-            other_index = data.index.difference(cluster_to_windows[c])
-            other_data = data[f][other_index]
-
-            # Two-sided kstest seems to give a lot of pvalue=1 where it shouldn't
-            (stat_less, pvalue_less) = ks_2samp(other_data, cluster_data, alternative="less", mode="exact")
-            (stat_great, pvalue_great) = ks_2samp(other_data, cluster_data, alternative="greater", mode="exact")
-            cluster_median = np.median(cluster_data)
-            other_median = np.median(other_data)
-            cluster_mean = np.mean(cluster_data)
-            other_mean = np.mean(other_data)
-
-            #Store cluster means for heatmap
-            if f not in cluster_means:
-                cluster_means[f] = dict()
-            cluster_means[f][c] = cluster_mean
-
-            if pvalue_less <= pvalue_cutoff or pvalue_great <= pvalue_cutoff:
-                sig_features.add(f)
-                if c not in cluster_results:
-                     cluster_results[c] = dict()
-                if f not in cluster_results[c]:
-                     cluster_results[c][f] = list()
-                cluster_results[c][f] = [cluster_data.size, other_data.size, stat_less, pvalue_less, stat_great, pvalue_great, cluster_median, other_median, cluster_mean, other_mean]
-                cluster_results_df = cluster_results_df.append({'cluster' : c, 'feature' : f, 'cluster_data.size' : cluster_data.size, 'other_data.size' : other_data.size, 'stat_less' : '{:.2f}'.format(stat_less), 'pvalue_less' : '{:.2e}'.format(pvalue_less), 'stat_great' : '{:.2f}'.format(stat_great), 'pvalue_great' : '{:.2e}'.format(pvalue_great), 'cluster_median' : '{:.5f}'.format(cluster_median), 'other_median' : '{:.5f}'.format(other_median), 'cluster_mean' : '{:.5f}'.format(cluster_mean), 'other_mean' : '{:.5f}'.format(other_mean)}, ignore_index=True)
-    return(sig_features, cluster_results_df, cluster_species_genome_prop, cluster_means)
+    write_lines(get_cluster_gff_lines(data), outdir + '/' + clusters_gff_fn, compress=compress)
 
 
 def feature_histograms(data, sig_features):
@@ -214,21 +467,34 @@ def feature_histograms(data, sig_features):
     return(feat_hist_dict)
 
 
+def binned_feature_histograms(data, sig_features, n_bins=FEATURE_HISTOGRAM_BINS):
+    '''Generate histograms of each significant feature in each cluster. All clusters of a feature share the same n_bins bins between the minimum and maximum of the feature,
+    and the counts of all clusters are found in one pass over the windows with np.bincount. Non-finite values are not counted.
+    Returns a dict with the clusters and, for each feature, the bin edges and the counts per cluster'''
+    clusters = np.unique(data['cluster'].to_numpy())
+    cluster_codes = np.searchsorted(clusters, data['cluster'].to_numpy())
+    feat_hist_dict = {'n_bins': n_bins, 'clusters': clusters.tolist(), 'features': dict()}
+    for f in sig_features:
+        values = data[f].to_numpy(dtype=np.float64)
+        is_finite = np.isfinite(values)
+        bin_edges = np.histogram_bin_edges(values[is_finite], bins=n_bins)
+        # The last bin includes its right edge, as in np.histogram
+        bin_indices = np.clip(np.searchsorted(bin_edges, values[is_finite], side='right') - 1, 0, n_bins - 1)
+        counts = np.bincount(cluster_codes[is_finite] * n_bins + bin_indices, minlength=len(clusters) * n_bins).reshape(len(clusters), n_bins)
+        feat_hist_dict['features'][f] = {'bin_edges': bin_edges.tolist(), 'counts': {str(c): counts[i].tolist() for (i, c) in enumerate(clusters)}}
+    return(feat_hist_dict)
+
+
 # Functions for writing data out for display with Dash
 def write_feature_table(table_df, outfile, outdir):
     '''Write table of significant features for reading by Dash'''
     table_df.to_csv(outdir + '/' + outfile, index=False)
 
 
-def write_embedding(emb, cluster_labels, species, outfile, outdir, cluster_colours):
+def write_embedding(emb, cluster_labels, species, outfile, outdir, cluster_colours, compress=False):
     '''Write out UMAP embedding for display with Dash'''
-    o = open(outdir + '/' + outfile, 'w')
-    o.write(','.join(['UMAP1', 'UMAP2', 'species', 'cluster', 'color']))
-    o.write('\n')
-    for i in range(0,len(cluster_labels)):
-        o.write(','.join([str(emb[i,0]), str(emb[i,1]), str(species[i]), str(cluster_labels[i]), str(cluster_colours[cluster_labels[i]])]))
-        o.write('\n')
-    o.close()
+    header = ','.join(['UMAP1', 'UMAP2', 'species', 'cluster', 'color'])
+    write_lines(get_embedding_lines(emb, cluster_labels, species, cluster_colours), outdir + '/' + outfile, header=header, compress=compress)
 
 
 def write_cluster_heatmap(cluster_means, sig_features, outfile, outdir):
@@ -272,6 +538,95 @@ def write_circos_json(json_dict, outfile, outdir):
         file.write(json.dumps(json_dict))
 
 
+def get_window_numbers(window_numbers_string):
+    '''Returns a list of the cluster position histogram window numbers from a comma separated string'''
+    return [float(x) for x in window_numbers_string.split(",")]
+
+
+def format_window_number(window_number):
+    '''Returns the cluster position histogram window number as a string, without a decimal point or exponent for whole numbers'''
+    if float(window_number).is_integer():
+        return "{:d}".format(int(window_number))
+    return "{}".format(window_number)
+
+
+def get_cluster_position_histogram_filename(window_number, is_default):
+    '''Returns the name of the cluster position histograms file. The histograms with the default window number are in clusterpos.json'''
+    if is_default:
+        return "clusterpos.json"
+    return "clusterpos_w{}.json".format(format_window_number(window_number))
+
+
+def write_species_outputs(data, s, cluster_colours, outdir, cluster_position_histogram_window_numbers, compress=False):
+    '''Write the BED file, cluster junction test, cluster position histograms, chromosome composition heatmap and Circos data of one species'''
+    species_data = data[data.species==s]
+    species_outdir = outdir + '/' + s
+    # Make species-specific directory
+    if not os.path.exists(species_outdir):
+        os.mkdir(species_outdir)
+    # Write BED file
+    write_cluster_bed(species_data, cluster_colours, species_outdir, compress=compress)
+
+    # Find which cluster junctions occur at a different rate than what is expected by chance, cluster histograms with window number,
+    # chromosome cluster composition and Circos data
+    analytics = get_species_analytics(species_data, cluster_colours, cluster_position_histogram_window_numbers)
+    analytics['cluster_junctions'].to_csv(species_outdir + '/cluster_junctions_fisher_test.csv')
+
+    # Write dicts of cluster position histograms out to files, one for each window number
+    cluster_position_histogram_files = dict()
+    for (i, window_number) in enumerate(cluster_position_histogram_window_numbers):
+        cluster_position_histogram_file = get_cluster_position_histogram_filename(window_number, i == 0)
+        write_json(analytics['cluster_positions'][window_number], cluster_position_histogram_file, species_outdir + '/')
+        cluster_position_histogram_files[cluster_position_histogram_file] = format_window_number(window_number)
+    # The window number of each cluster position histograms file, for the window number menu of the Shiny app
+    write_json(cluster_position_histogram_files, CLUSTER_POSITION_FILES_FILENAME, species_outdir + '/')
+
+    #####################
+    #Make heatmap of chromosome cluster composition
+    chr_composition_heatmap_file = "chrcompheat.csv"
+    write_chr_comp_heatmap(analytics['chromosome_composition'], chr_composition_heatmap_file, species_outdir + '/')
+
+    ######################
+    # Make JSON files for Circos data
+    ######################
+    write_circos_json(analytics['circos'], 'circos.json', species_outdir + '/')
+
+
+def run_species_outputs(data, s, cluster_colours, outdir, cluster_position_histogram_window_numbers, compress=False):
+    '''Write the outputs of one species, returning the species name and None, or the traceback of the error if writing the outputs failed'''
+    try:
+        write_species_outputs(data, s, cluster_colours, outdir, cluster_position_histogram_window_numbers, compress)
+    except Exception:
+        return(s, traceback.format_exc())
+    return(s, None)
+
+
+def run_species_outputs_task(task):
+    '''Pool task wrapper of run_species_outputs'''
+    return run_species_outputs(*task)
+
+
+def write_all_species_outputs(data, cluster_colours, outdir, cluster_position_histogram_window_numbers, workers=1, compress=False):
+    '''Write the outputs of each species, using a pool of worker processes if workers > 1.
+    The species outputs only need the coordinates and clusters of the windows, so the windows of each species are taken from these columns only,
+    one species at a time, and each worker gets only the windows of its species.
+    Returns a dict of species names and error tracebacks for the species whose outputs could not be written'''
+    species_data = data[SPECIES_OUTPUT_COLUMNS]
+    species_list = sorted(set(species_data['species'].tolist()))
+    tasks = ((species_data[species_data.species==s], s, cluster_colours, outdir, cluster_position_histogram_window_numbers, compress) for s in species_list)
+    if workers > 1 and len(species_list) > 1:
+        with Pool(min(workers, len(species_list))) as pool:
+            results = list(pool.imap(run_species_outputs_task, tasks, chunksize=1))
+    else:
+        results = [run_species_outputs_task(task) for task in tasks]
+    failed_species = dict()
+    for (s, error) in results:
+        if error is not None:
+            sys.stderr.write("Failed to write the outputs of species {}:\n{}\n".format(s, error))
+            failed_species[s] = error
+    return failed_species
+
+
 def check_umap_version():
     '''Check UMAP version and print a warning if it is not what is expected. UMAP crashes if it's a version that is too old (e.g. 0.4.2)'''
     installed_umap_version = umap.__version__
@@ -280,7 +635,7 @@ def check_umap_version():
         sys.stderr.write("Warning: UMAP version appears to be different from what is expected for the GDA pipeline (the installed version is {} but the expected version is {})\n".format(installed_umap_version, expected_umap_version))
 
 
-def main(umap_n_neighbors, hdbscan_min_cluster_size, pvalue_cutoff, cluster_position_histogram_window_number, outdir, tracks_file):
+def main(umap_n_neighbors, hdbscan_min_cluster_size, pvalue_cutoff, cluster_position_histogram_window_numbers, outdir, tracks_file):
     #################
     # Procedural code
     #################
@@ -296,95 +651,112 @@ def main(umap_n_neighbors, hdbscan_min_cluster_size, pvalue_cutoff, cluster_posi
     else:
         sys.stderr.write("{} already exists\n".format(outdir))
 
-    # Read in GDA data tracks as pandas data frame
-    # GDA data tracks file format: window_name (unique), species, chromosome, start, end, feature_values (tab separated)
-    data = pd.read_csv(tracks_file, sep='\t', index_col=0)
-
-    # Filter windows remove any N-containing windows
-    if 'N_percentage' in data.columns:
-        data.drop(index=data[data.N_percentage>0].index, axis=0, inplace=True)
-
-    # Make a dataframe with only window_name index and feature values suitable for clustering
-    data_to_cluster = data.drop(['species', 'start', 'end', 'chromosome'], axis=1)
+    profiler = RunProfiler(use_cprofile=args.profile)
 
-    # Get UMAP embedding for the data
-    sys.stderr.write("Running UMAP\n")
-    embedding = run_umap(data_to_cluster, umap_n_neighbors)
-
-    # cluster UMAP embedding using HDBSCAN
-    sys.stderr.write("Running HDBSCAN\n")
-    cluster_labels = run_hdbscan(embedding, args.leaf_size, args.min_samples, min_cluster_size=hdbscan_min_cluster_size)
+    # Read in GDA data tracks as pandas data frame
+    with profiler.stage("load"):
+        data = read_tracks_table(tracks_file, compact=args.low_memory)
+    with profiler.stage("filter"):
+        filter_windows(data)
+
+    with profiler.stage("feature matrix"):
+        feature_columns = [f for f in data.columns if f not in ('species', 'start', 'end', 'chromosome')]
+        if args.low_memory:
+            # A single float32 array of feature values that is scaled in place and passed to UMAP
+            data_to_cluster = get_feature_matrix(data, feature_columns)
+        else:
+            # Make a dataframe with only window_name index and feature values suitable for clustering
+            data_to_cluster = data.drop(['species', 'start', 'end', 'chromosome'], axis=1)
+    copy_scaled_data = not args.low_memory
+
+    if args.landmarks > 0 and args.landmarks < len(data.index):
+        # Cluster a stratified subsample of windows and assign the rest of the windows to its clusters
+        with profiler.stage("landmark clustering"):
+            (scaler, reducer, clusterer, embedding, cluster_labels, landmark_report) = run_landmark_clustering(data, data_to_cluster, args.landmarks, umap_n_neighbors, args.leaf_size, args.min_samples, hdbscan_min_cluster_size, args.landmark_batch_size, args.landmark_holdout, copy=copy_scaled_data)
+        write_json(landmark_report, 'landmark_report.json', outdir)
+    elif args.save_models:
+        # The fitted models are needed for projecting new windows, so the embedding cache is not used
+        sys.stderr.write("Running UMAP\n")
+        with profiler.stage("UMAP"):
+            (scaler, reducer, embedding) = fit_umap_models(data_to_cluster, umap_n_neighbors, copy=copy_scaled_data)
+        sys.stderr.write("Running HDBSCAN\n")
+        with profiler.stage("HDBSCAN"):
+            clusterer = fit_hdbscan(embedding, args.leaf_size, args.min_samples, min_cluster_size=hdbscan_min_cluster_size, prediction_data=True)
+        cluster_labels = clusterer.labels_
+    else:
+        with profiler.stage("scale"):
+            scaled_data = scale_data(data_to_cluster, copy=copy_scaled_data)
+        # Get UMAP embedding for the data
+        sys.stderr.write("Running UMAP\n")
+        embedding_cache = get_embedding_cache(args.embedding_cache_dir, args.embedding_cache_size, outdir)
+        knn_graph = None
+        if args.knn_n_neighbors > 0:
+            # Nearest neighbours found at the largest n_neighbors value of a parameter sweep give the same embedding (and embedding cache key) as the sweep
+            knn_graph = NearestNeighbourGraph(scaled_data, args.knn_n_neighbors)
+        with profiler.stage("UMAP"):
+            embedding = run_umap_on_scaled_data(scaled_data, umap_n_neighbors, embedding_cache=embedding_cache, knn_graph=knn_graph)
+        del scaled_data, knn_graph
+
+        # cluster UMAP embedding using HDBSCAN
+        sys.stderr.write("Running HDBSCAN\n")
+        with profiler.stage("HDBSCAN"):
+            cluster_labels = run_hdbscan(embedding, args.leaf_size, args.min_samples, min_cluster_size=hdbscan_min_cluster_size)
+    # The enrichment tests and histograms use the feature values in data, so the clustered feature values are freed before them
+    # (a UMAP reducer saved with --save_models keeps its own reference to them)
+    del data_to_cluster
     cluster_colours = get_cluster_cols_dict(max(set(cluster_labels)))
 
+    if args.save_models:
+        models = {'feature_columns': feature_columns, 'scaler': scaler, 'reducer': reducer, 'clusterer': clusterer, 'cluster_colours': cluster_colours, 'n_neighbors': umap_n_neighbors, 'min_cluster_size': hdbscan_min_cluster_size}
+        save_models(models, 'gda_models.pkl', outdir)
+
     # Add cluster data to main data frame
     data['cluster'] = cluster_labels
 
-    # Write out UMAP embedding
-    outfile = "umap_clustering.csv"
-    write_embedding(embedding, cluster_labels, data['species'].tolist(), outfile, outdir, cluster_colours)
+    with profiler.stage("embedding and GFF output"):
+        # Write out UMAP embedding
+        outfile = "umap_clustering.csv"
+        write_embedding(embedding, cluster_labels, data['species'].tolist(), outfile, outdir, cluster_colours)
 
-    # Write GFF file of clusters
-    write_cluster_gff(data, outdir)
+        # Write GFF file of clusters
+        write_cluster_gff(data, outdir, compress=args.bgzip)
 
     #########################
     # Get significant features, significant feature stats per cluster, proportion of each cluster in each species and cluster means (for heatmap)
-    # This step is very slow - needs optimising!
     sys.stderr.write("Determining enriched features\n")
-    (sig_features, cluster_results, cluster_species_genome_prop, cluster_means) = get_significant_features(data, pvalue_cutoff)
+    with profiler.stage("enrichment"):
+        (sig_features, cluster_results, cluster_species_genome_prop, cluster_means) = get_significant_features(data, pvalue_cutoff, workers=args.workers, ks_mode=args.ks_mode)
 
-    # Write sig features for reading by Dash
-    feature_table_filename = "feattable.csv"
-    write_feature_table(cluster_results, feature_table_filename, outdir)
-    # Write genome proportions
-    genome_prop_outfile = "genomeprops.csv"
-    write_genome_prop(cluster_species_genome_prop, genome_prop_outfile, outdir)
+        # Write sig features for reading by Dash
+        feature_table_filename = "feattable.csv"
+        write_feature_table(cluster_results, feature_table_filename, outdir)
+        # Write genome proportions
+        genome_prop_outfile = "genomeprops.csv"
+        write_genome_prop(cluster_species_genome_prop, genome_prop_outfile, outdir)
 
-    # Write cluster/feature heatmap data
-    cluster_heatmap_filename = 'cluster_heatmap.csv'
-    write_cluster_heatmap(cluster_means, sig_features, cluster_heatmap_filename, outdir)
+        # Write cluster/feature heatmap data
+        cluster_heatmap_filename = 'cluster_heatmap.csv'
+        write_cluster_heatmap(cluster_means, sig_features, cluster_heatmap_filename, outdir)
 
     ####################
     # Make data for feature histograms
-    feat_hist_dict = feature_histograms(data, sig_features)
-    feat_hist_filename = "feathist.json"
-    write_json(feat_hist_dict, feat_hist_filename, outdir)
+    with profiler.stage("histograms"):
+        feat_hist_dict = binned_feature_histograms(data, sig_features)
+        write_json(feat_hist_dict, "feathist_binned.json", outdir)
+        if args.raw_feature_histograms:
+            # Lists of the values of each significant feature in each cluster
+            feat_hist_dict = feature_histograms(data, sig_features)
+            write_json(feat_hist_dict, "feathist.json", outdir)
 
     #####################################
     # Species separated for these analyses
     ################
-    for s in sorted(sorted(set(data['species'].tolist()))):
-        # Make species-specific directory
-        if not os.path.exists(outdir + '/' + s):
-            os.mkdir(outdir + '/' + s)
-        # Write BED file
-        bed_cluster_file = write_cluster_bed(data[data.species==s], cluster_colours, outdir + '/' + s)
-        # Run the script that finds which cluster junctions in the BED file occur at a different rate than what is expected by chance
-        cluster_junctions_command = "cluster_junctions_fisher_test.py {} {}".format(outdir + '/' + s + '/' + bed_cluster_file, outdir + '/' + s)
-        t = os.system(cluster_junctions_command)
-        if t != 0:
-            sys.stderr.write("Error running command {}\n".format(cluster_junctions_command))
-            sys.exit(1)
-        # Read back BED file of data (this could be optimised!)
-        bed_data = BedFile(outdir + '/' + s + '/' + bed_cluster_file)
-
-        #########################################
-        # Generate cluster histograms with window number
-        window_freqs = bed_data.cluster_histograms(cluster_position_histogram_window_number)
-        # Write dict of data out to file
-        cluster_position_histogram_file = "clusterpos.json"
-        write_json(window_freqs, cluster_position_histogram_file, outdir + '/' + s + '/')
-
-        #####################
-        #Make heatmap of chromosome cluster composition
-        comp_res = bed_data.chromosome_composition()
-        chr_composition_heatmap_file = "chrcompheat.csv"
-        write_chr_comp_heatmap(comp_res, chr_composition_heatmap_file, outdir + '/' + s + '/')
-
-        ######################
-        # Make JSON files for Circos data
-        ######################
-        circos_json_dict = bed_data.circos_json()
-        write_circos_json(circos_json_dict, 'circos.json', outdir + '/' + s + '/')
+    with profiler.stage("species outputs"):
+        failed_species = write_all_species_outputs(data, cluster_colours, outdir, cluster_position_histogram_window_numbers, workers=args.workers, compress=args.bgzip)
+    profiler.write(outdir)
+    if len(failed_species) > 0:
+        sys.stderr.write("The outputs of the following species could not be written: {}\n".format(", ".join(sorted(failed_species))))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -395,13 +767,33 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--n_neighbors", help="N neighbours argument for UMAP [13]", default=13, type=int)
     parser.add_argument("-c", "--cluster_size_cutoff", help="HDBSCAN min cluster size [200]", default=200, type=int)
     parser.add_argument("-p", "--pvalue_cutoff", help="p-value cutoff for feature enrichment in clusters [1e-20]", default=1e-20, type=float)
-    parser.add_argument("-w", "--cluster_position_histogram_window_number", help="Cluster position histogram window number", default=20, type=float)
+    parser.add_argument("-w", "--cluster_position_histogram_window_number", help="Cluster position histogram window number. Several comma separated window numbers (e.g. 20,50,100) can be given, for choosing the resolution of the cluster position line charts in the Shiny app: the histograms with the first window number are written to clusterpos.json and the others to clusterpos_w<window number>.json [20]", default="20", type=str)
     parser.add_argument("--leaf_size", help="leaf_size setting for HDBSCAN (default: 40)", default=40, type=int)
     parser.add_argument("--min_samples", help="min_samples setting for HDBSCAN (default: None)", default=None, type=int)
+    parser.add_argument("--ks_mode", help="Method for calculating Kolmogorov-Smirnov test p-values of feature enrichment: exact, asymp (asymptotic) or auto (asymptotic for large clusters, exact near the p-value cutoff) (default: exact)", default="exact", choices=KS_MODES, type=str)
+    parser.add_argument("--workers", help="Number of worker processes for the feature enrichment tests and for writing the outputs of each species (default: 1)", default=1, type=int)
+    parser.add_argument("--landmarks", help="Optional: number of landmark windows. If this is smaller than the number of windows, UMAP and HDBSCAN are run on a subsample of windows (stratified by species and chromosome) and the other windows are assigned to its clusters. The HDBSCAN min cluster size is scaled by the fraction of windows that are landmarks, so that it keeps its meaning in windows of the whole table (default: 0, all windows are clustered)", default=0, type=int)
+    parser.add_argument("--landmark_batch_size", help="Number of windows assigned to landmark clusters at a time (default: 100000)", default=100000, type=int)
+    parser.add_argument("--landmark_holdout", help="Number of held-out windows for comparing the landmark clustering with a clustering that includes them, reported in landmark_report.json. 0 skips the comparison (default: 2000)", default=2000, type=int)
+    parser.add_argument("--save_models", help="Save the fitted scaler, UMAP and HDBSCAN models to gda_models.pkl in the output dir, for projecting new assemblies into the clustering with gda_project.py", action="store_true")
+    parser.add_argument("--low_memory", help="Read feature values as float32 and species and chromosome names as categoricals, and scale the feature matrix in place, to reduce the peak memory use of large runs. Results can differ slightly from the default float64 run", action="store_true")
+    parser.add_argument("--bgzip", help="Write clusters.bed and clusters.gff files as bgzip-compressed files (clusters.bed.gz and clusters.gff.gz)", action="store_true")
+    parser.add_argument("--raw_feature_histograms", help="In addition to the binned feature histograms (feathist_binned.json), write the values of each significant feature in each cluster to feathist.json. This file can be very large for large datasets", action="store_true")
+    parser.add_argument("--profile", help="Run each stage under cProfile and save the profile of the slowest stage to the output dir (see run_profile.json for the file name)", action="store_true")
+    parser.add_argument("--knn_n_neighbors", help="Optional: find the nearest neighbours of each window at this larger number of neighbours and run UMAP with the closest n_neighbors of them, as gda clustering_params does. Set to the largest n_neighbors value of a gda clustering_params run to reproduce its embedding for n_neighbors, which is then loaded from the embedding cache. Not used with --save_models or --landmarks (default: 0, the neighbours are searched for at n_neighbors)", default=0, type=int)
+    parser.add_argument("--embedding_cache_dir", help="Folder for cached UMAP embeddings (default: the hidden .umap_embedding_cache folder in the output dir)", default="", type=str)
+    parser.add_argument("--embedding_cache_size", help="Maximum size of the UMAP embedding cache in MB, least recently used embeddings are removed above this size. 0 disables the cache (default: 2000)", default=2000, type=int)
     parser.add_argument("-d", "--directory", help="Output dir [gda_out]", default="gda_out", type=str)
-    parser.add_argument("tracks", help="File of windowed GDA tracks", type=str)
+    parser.add_argument("tracks", help="File of windowed GDA tracks (merged TSV file or columnar tracks folder made with gda convert_tracks)", type=str)
     args = parser.parse_args()
-    main(args.n_neighbors, args.cluster_size_cutoff, args.pvalue_cutoff, args.cluster_position_histogram_window_number, args.directory, args.tracks)
+    if args.knn_n_neighbors > 0:
+        if args.knn_n_neighbors < args.n_neighbors:
+            sys.stderr.write("--knn_n_neighbors ({}) has to be at least n_neighbors ({})\n".format(args.knn_n_neighbors, args.n_neighbors))
+            sys.exit(1)
+        if args.save_models or args.landmarks > 0:
+            sys.stderr.write("--knn_n_neighbors cannot be used with --save_models or --landmarks\n")
+            sys.exit(1)
+    main(args.n_neighbors, args.cluster_size_cutoff, args.pvalue_cutoff, get_window_numbers(args.cluster_position_histogram_window_number), args.directory, args.tracks)
 
 
 
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Clustering quality metrics for the GDA parameter sweep.
+The silhouette score needs the distances between all pairs of windows, so for large embeddings it is estimated from a stratified random
+sample of the windows, with a confidence interval. The silhouette values of the sampled windows are exact: their distances to all windows
+are calculated in blocks of bounded size. The distances are calculated once per embedding and shared by the clusterings of all min cluster sizes
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn import metrics
+from sklearn.utils import check_random_state
+
+# Embeddings with more windows than this get a sampled silhouette score
+SILHOUETTE_SAMPLE_SIZE = 20000
+# Maximum size in MB of a block of the distance matrix between the sampled windows and all windows
+SILHOUETTE_WORKING_MEMORY_MB = 256
+# z value of the two-sided 95% confidence interval of the sampled silhouette scores
+CONFIDENCE_INTERVAL_Z = 1.959963984540054
+
+
+class EmbeddingMetrics():
+    ''' Clustering quality metrics of the clusterings of one UMAP embedding.
+    If the embedding has more than sample_size windows, silhouette scores are estimated from a random sample of windows, stratified by cluster.
+    Each window gets a random sampling priority once per embedding and the windows with the lowest priorities are sampled from each cluster,
+    so the samples of different clusterings mostly contain the same windows and their distances to all windows only need to be calculated once'''
+    def __init__(self, embedding, sample_size=SILHOUETTE_SAMPLE_SIZE, random_state=123, metric='euclidean', working_memory=SILHOUETTE_WORKING_MEMORY_MB):
+        self.embedding = embedding
+        self.sample_size = sample_size
+        self.metric = metric
+        self.working_memory = working_memory
+        self.sampling_priority = check_random_state(random_state).permutation(len(embedding))
+
+    def is_sampled(self):
+        '''Returns True if silhouette scores are estimated from a sample of the windows'''
+        return self.sample_size > 0 and self.sample_size < len(self.embedding)
+
+    def get_silhouette_sample(self, cluster_codes, cluster_sizes):
+        '''Returns the indices of the windows sampled for the silhouette score and the number of windows sampled from each cluster.
+        The number of windows sampled from a cluster is proportional to the size of the cluster, with at least one window per cluster'''
+        n_windows = len(cluster_codes)
+        if not self.is_sampled():
+            return (np.arange(n_windows), cluster_sizes)
+        sampled_sizes = np.minimum(cluster_sizes, np.maximum(1, np.round(self.sample_size * cluster_sizes / n_windows).astype(np.int64)))
+        # Windows ordered by cluster and then by sampling priority, the first windows of each cluster are sampled
+        order = np.lexsort((self.sampling_priority, cluster_codes))
+        cluster_starts = np.cumsum(cluster_sizes) - cluster_sizes
+        rank_in_cluster = np.arange(n_windows) - np.repeat(cluster_starts, cluster_sizes)
+        sample_indices = np.sort(order[rank_in_cluster < np.repeat(sampled_sizes, cluster_sizes)])
+        return (sample_indices, sampled_sizes)
+
+    def get_cluster_distance_sums(self, row_indices, cluster_indicators):
+        '''Returns a list with an array for each clustering, with the sums of the distances from each of the windows in row_indices to the windows of each cluster.
+        cluster_indicators is a list of sparse (windows x clusters) indicator matrices, one per clustering'''
+        def reduce_distances(distance_block, start):
+            # The distance of a window to itself is set to exactly 0, as rounding errors can make it slightly positive
+            block_rows = np.arange(len(distance_block))
+            distance_block[block_rows, row_indices[start + block_rows]] = 0
+            return tuple(np.asarray(cluster_indicator.T.dot(distance_block.T).T) for cluster_indicator in cluster_indicators)
+
+        distance_sums = [list() for x in cluster_indicators]
+        for block_sums in metrics.pairwise_distances_chunked(self.embedding[row_indices], self.embedding, reduce_func=reduce_distances, metric=self.metric, working_memory=self.working_memory):
+            for i, x in enumerate(block_sums):
+                distance_sums[i].append(x)
+        return [np.vstack(x) for x in distance_sums]
+
+    def silhouette_scores(self, cluster_labels_list):
+        '''Returns a list with a dict for each clustering in cluster_labels_list, with the silhouette score, the bounds of its 95% confidence interval
+        and the number of windows that it was calculated from. The confidence interval of an exact score is the score itself.
+        The score is None if the number of clusters is not between 2 and the number of windows - 1.
+        As in sklearn.metrics.silhouette_score, unclassified windows (label -1) are treated as one cluster'''
+        clusterings = list()
+        for cluster_labels in cluster_labels_list:
+            (cluster_codes, cluster_sizes) = np.unique(cluster_labels, return_inverse=True, return_counts=True)[1:]
+            if len(cluster_sizes) < 2 or len(cluster_sizes) > len(cluster_labels) - 1:
+                clusterings.append(None)
+                continue
+            (sample_indices, sampled_sizes) = self.get_silhouette_sample(cluster_codes, cluster_sizes)
+            cluster_indicator = csr_matrix((np.ones(len(cluster_codes)), (np.arange(len(cluster_codes)), cluster_codes)), shape=(len(cluster_codes), len(cluster_sizes)))
+            clusterings.append({'codes': cluster_codes, 'sizes': cluster_sizes, 'sample_indices': sample_indices, 'sampled_sizes': sampled_sizes, 'indicator': cluster_indicator})
+
+        valid_clusterings = [x for x in clusterings if x is not None]
+        if len(valid_clusterings) > 0:
+            row_indices = np.unique(np.concatenate([x['sample_indices'] for x in valid_clusterings]))
+            distance_sums = self.get_cluster_distance_sums(row_indices, [x['indicator'] for x in valid_clusterings])
+            for (clustering, clustering_distance_sums) in zip(valid_clusterings, distance_sums):
+                clustering['distance_sums'] = clustering_distance_sums[np.searchsorted(row_indices, clustering['sample_indices'])]
+
+        scores = list()
+        for clustering in clusterings:
+            if clustering is None:
+                scores.append({'silhouette_score': None, 'silhouette_score_ci_lower': None, 'silhouette_score_ci_upper': None, 'silhouette_sample_size': None})
+                continue
+            silhouette_values = get_silhouette_values(clustering['distance_sums'], clustering['codes'][clustering['sample_indices']], clustering['sizes'])
+            (score, standard_error) = get_stratified_mean(silhouette_values, clustering['codes'][clustering['sample_indices']], clustering['sizes'], clustering['sampled_sizes'])
+            scores.append({'silhouette_score': score, 'silhouette_score_ci_lower': score - CONFIDENCE_INTERVAL_Z * standard_error,
+                           'silhouette_score_ci_upper': score + CONFIDENCE_INTERVAL_Z * standard_error, 'silhouette_sample_size': len(silhouette_values)})
+        return scores
+
+    def clustering_metrics(self, cluster_labels_list):
+        '''Returns a list with a dict of clustering metrics for each clustering in cluster_labels_list: silhouette score (see silhouette_scores),
+        Davies-Bouldin index and Calinski-Harabasz score. The metrics are None if there is only one cluster'''
+        metrics_list = self.silhouette_scores(cluster_labels_list)
+        for (cluster_labels, clustering_metrics) in zip(cluster_labels_list, metrics_list):
+            clustering_metrics['davies_bouldin_index'] = None
+            clustering_metrics['calinski_harabasz_score'] = None
+            if clustering_metrics['silhouette_score'] is not None:
+                clustering_metrics['davies_bouldin_index'] = metrics.davies_bouldin_score(self.embedding, cluster_labels)
+                clustering_metrics['calinski_harabasz_score'] = metrics.calinski_harabasz_score(self.embedding, cluster_labels)
+        return metrics_list
+
+
+def get_silhouette_values(distance_sums, cluster_codes, cluster_sizes):
+    '''Returns the silhouette values of windows from the sums of their distances to the windows of each cluster (windows x clusters array)
+    and their cluster codes. Windows in clusters of one window get a silhouette value of 0, as in sklearn.metrics.silhouette_samples'''
+    rows = np.arange(len(cluster_codes))
+    own_cluster_sizes = cluster_sizes[cluster_codes]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intra_distances = distance_sums[rows, cluster_codes] / (own_cluster_sizes - 1)
+        mean_distances = distance_sums / cluster_sizes
+        mean_distances[rows, cluster_codes] = np.inf
+        inter_distances = mean_distances.min(axis=1)
+        silhouette_values = (inter_distances - intra_distances) / np.maximum(intra_distances, inter_distances)
+    silhouette_values[own_cluster_sizes == 1] = 0
+    return np.nan_to_num(silhouette_values)
+
+
+def get_stratified_mean(values, strata, stratum_sizes, sampled_sizes):
+    '''Returns the estimate of the population mean and its standard error from a stratified random sample,
+    where values are the sampled values, strata the stratum of each value and stratum_sizes the population size of each stratum.
+    Fully sampled strata do not add to the standard error'''
+    stratum_weights = stratum_sizes / stratum_sizes.sum()
+    stratum_means = np.bincount(strata, weights=values, minlength=len(stratum_sizes)) / sampled_sizes
+    squared_deviations = (values - stratum_means[strata])**2
+    stratum_variances = np.zeros(len(stratum_sizes))
+    has_variance = sampled_sizes > 1
+    stratum_variances[has_variance] = np.bincount(strata, weights=squared_deviations, minlength=len(stratum_sizes))[has_variance] / (sampled_sizes[has_variance] - 1)
+    finite_population_correction = 1 - sampled_sizes / stratum_sizes
+    variance = np.sum(stratum_weights**2 * finite_population_correction * stratum_variances / sampled_sizes)
+    return (float(np.sum(stratum_weights * stratum_means)), float(np.sqrt(variance)))
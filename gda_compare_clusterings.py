@@ -29,6 +29,7 @@ Compare two different GDA clusterings of the same data by displaying them as a g
 # SOFTWARE.
 
 import sys
+import gzip
 import networkx as nx
 import matplotlib.pyplot as plt
 
@@ -39,8 +40,8 @@ min_shared = 0
 edge_weight_factor = 10 # scale the edge weights
 
 def get_clusters(file):
-    '''Given a gff file 'clusters.gff' from GDA, extract the windows and their cluster identity'''
-    f = open(file)
+    '''Given a gff file 'clusters.gff' from GDA, extract the windows and their cluster identity. Files with the .gz extension (clusters.gff.gz) are decompressed'''
+    f = gzip.open(file, 'rt') if file.endswith('.gz') else open(file)
     results = dict()
     for x in f.readlines():
         x = x.rstrip()
@@ -2,6 +2,9 @@
 """
 Script for concatenating TSV tables (that have been made from bedgraph files) from multiple GDA runs, in order to cluster the data from multiple genomes together. 
 Input: paths to TSV files. Output (STDOUT): a concatenated TSV file.
+Each input file is read once, in chunks, in parallel worker processes that write the shared columns to temporary files and collect the values needed
+for checking the window sizes and duplicate species, chromosomes and windows. The temporary files are written to STDOUT after all checks have passed.
+All problems found by the checks are reported together
 """
 # MIT License
 # 
@@ -32,132 +35,161 @@ Input: paths to TSV files. Output (STDOUT): a concatenated TSV file.
 import pandas as pd
 import os.path
 import sys
-from collections import OrderedDict
+import io
+import itertools
+import shutil
+import tempfile
+import traceback
 import argparse
+from multiprocessing import Pool
+from gda_tracks_io import is_columnar_tracks, load_columnar_metadata, read_tracks_columnar
+from gda_table_validation import REQUIRED_COLUMNS, ValidationReport, check_duplicate_files, check_required_columns, check_noncommon_columns, get_window_steps, check_window_sizes, check_duplicate_entries
 
-
-def validate_tsv(tsv_file):
-    """
-    Checks if the input file is a TSV file and has the mandatory columns
-    """
-    REQUIRED_COLUMNS = ("window", "start", "end", "species", "chromosome")
-    if os.path.isfile(tsv_file) == False:
-        sys.stderr.write("Input file {} was not found\n".format(tsv_file))
-        sys.exit(1)
-    try:
-        df = pd.read_csv(tsv_file, sep="\t")
-    except pd.errors.ParserError as e:
-        sys.stderr.write("Failed to parse the input file {} as a TSV (tab separated values) file\n".format(tsv_file))
-        sys.stderr.write(str(e) + "\n")
-        sys.exit(1)
-    except ValueError as e:
-        sys.stderr.write("Failed to parse the input file {} as a TSV (tab separated values) file\n".format(tsv_file))
-        sys.stderr.write(str(e) + "\n")
-        sys.exit(1)
-    except:
-        sys.stderr.write("Failed to parse the input file {} as a TSV (tab separated values) file\n".format(tsv_file))
-        sys.stderr.write("Unexpected error: " + str(sys.exc_info()[0]) + "\n")
-        sys.exit(1)
-    df_colnames = df.columns
-    
-    for required_col in REQUIRED_COLUMNS:
-        if required_col not in df_colnames:
-            sys.stderr.write("Required column with the name '{}' was not found in the input TSV file {}\n".format(required_col, tsv_file))
-            sys.exit(1)
+# Number of rows of an input file that are read and written at a time
+TSV_CHUNK_SIZE = 20000
 
 
-def detect_window_size(df, tsv_file):
+def read_tsv_header(tsv_file, report):
     """
-    Detects window size in the input TSV file
+    Checks if the input file is a TSV file and has the mandatory columns. Returns the column names, or None if the file cannot be used.
+    Problems are added to the ValidationReport. Only the header of the file is read: the rest of the file is parsed when it is concatenated
     """
-    start_coords = df["start"].tolist()
-    diff_list = list()
-    previous_start_coord = 0
-    for start_coord in start_coords:
-        if start_coord > previous_start_coord:
-            diff = start_coord - previous_start_coord
-            diff_list.append(diff)
-        previous_start_coord = start_coord
-    diff_set = set(diff_list)
-    window_size = None
-    if len(diff_set) > 1:
-        sys.stderr.write("More than one window step size ({}) was found in the file {}\n".format(",".join(diff_set), tsv_file))
-        sys.exit(1)
+    if is_columnar_tracks(tsv_file):
+        metadata = load_columnar_metadata(tsv_file)
+        df_colnames = [metadata["index_name"]] + [col["name"] for col in metadata["columns"]]
+    elif os.path.isfile(tsv_file) == False:
+        report.add("input_file", "Input file {} was not found".format(tsv_file), tsv_file)
+        return None
     else:
-        window_size = list(diff_set)[0]
-    return window_size
-
-
-def check_for_noncommon_columns(df_dict):
+        try:
+            df_colnames = pd.read_csv(tsv_file, sep="\t", nrows=0).columns.tolist()
+        except (pd.errors.ParserError, ValueError) as e:
+            report.add("input_file", "Failed to parse the input file {} as a TSV (tab separated values) file: {}".format(tsv_file, str(e)), tsv_file)
+            return None
+        except:
+            report.add("input_file", "Failed to parse the input file {} as a TSV (tab separated values) file. Unexpected error: {}".format(tsv_file, str(sys.exc_info()[0])), tsv_file)
+            return None
+    if not check_required_columns(report, tsv_file, df_colnames):
+        return None
+    return df_colnames
+
+
+def iter_tsv_chunks(tsv_file, file_columns, columns):
     """
-    Finds variable columns that are not shared between the input TSV files.
-    These columns will be left out from the output TSV file
+    Yields data frames of consecutive rows of an input TSV file or columnar tracks folder with the given columns, and the text of these rows for the output,
+    or None if the data frame is to be written out instead. If a TSV file has exactly the given columns, its lines are copied to the output unchanged
+    and only the columns needed for the checks are parsed. Otherwise the values of the given columns are read as text, so they are also written out unchanged
     """
-    common_cols = list(set.intersection(*(set(df.columns) for df in list(df_dict.values()))))
-    for tsv_file in df_dict:
-        noncommon_cols = [n for n in df_dict[tsv_file].columns if n not in common_cols]
-        if len(noncommon_cols) > 0:
-            sys.stderr.write("Warning: the following column(s) from the file {} will not be used, as they do not occur in the other TSV file(s): {}\n".format(tsv_file, ", ".join(noncommon_cols)))
-
-
-def check_for_duplicate_entries(df_dict):
+    if is_columnar_tracks(tsv_file):
+        index_name = load_columnar_metadata(tsv_file)["index_name"]
+        df = read_tracks_columnar(tsv_file, columns=[x for x in columns if x != index_name]).reset_index()[columns]
+        for chunk_start in range(0, len(df.index), TSV_CHUNK_SIZE):
+            yield (df.iloc[chunk_start:chunk_start + TSV_CHUNK_SIZE], None)
+        return
+    copy_lines = file_columns == columns
+    with open(tsv_file) as f:
+        f.readline()
+        while True:
+            lines = list(itertools.islice(f, TSV_CHUNK_SIZE))
+            if len(lines) == 0:
+                break
+            # Blank lines are skipped, as when the file is parsed with pandas
+            lines = [x for x in lines if x.strip() != ""]
+            if len(lines) == 0:
+                continue
+            if not lines[-1].endswith("\n"):
+                lines[-1] += "\n"
+            chunk_text = "".join(lines)
+            chunk = pd.read_csv(io.StringIO(chunk_text), sep="\t", header=None, names=file_columns, usecols=list(REQUIRED_COLUMNS) if copy_lines else columns, dtype=str, na_filter=False)
+            yield (chunk, chunk_text if copy_lines else None)
+
+
+def scan_tsv_file(tsv_file, file_columns, columns, out_path):
     """
-    The values in the columns 'species', 'chromosome' and 'window' have to be different in each input TSV file.
-    This function checks if they are different and exits the script if two or more TSV files share the same value
+    Reads an input file once, writing the given columns to out_path (without a header) and collecting the window steps and
+    the sets of species, chromosome and window values of the file. Returns a dict of these and None, or None and the traceback of the error
+    if the file could not be read
     """
-    col_labels = ["species", "chromosome", "window"]
-    for col_label in col_labels:
-        entries_collection = list()
-        for tsv_file in df_dict:
-            entries_set = set(df_dict[tsv_file][col_label].tolist())
-            for col_value in entries_set:
-                if col_value in entries_collection:
-                    sys.stderr.write("Value {} appears in the '{}' column in more than one input file\n".format(col_value, col_label))
-                    sys.exit(1)
+    try:
+        window_steps = set()
+        previous_window = None
+        entries = {"species": set(), "chromosome": set(), "window": set()}
+        with open(out_path, "w") as f:
+            for (chunk, chunk_text) in iter_tsv_chunks(tsv_file, file_columns, columns):
+                (chunk_window_steps, previous_window) = get_window_steps(chunk["chromosome"].astype(str).to_numpy(), pd.to_numeric(chunk["start"]).to_numpy(), previous_window)
+                window_steps.update(chunk_window_steps)
+                entries["species"].update(pd.unique(chunk["species"].astype(str)).tolist())
+                entries["chromosome"].update(pd.unique(chunk["chromosome"].astype(str)).tolist())
+                entries["window"].update(chunk["window"].astype(str).tolist())
+                if chunk_text is None:
+                    chunk[columns].to_csv(f, index=False, sep="\t", header=False)
                 else:
-                    entries_collection.append(col_value)
+                    f.write(chunk_text)
+        return ({"window_steps": window_steps, "entries": entries}, None)
+    except:
+        return (None, traceback.format_exc())
 
 
-def check_window_sizes(df_dict):
+def scan_tsv_file_task(task):
     """
-    The input TSV files need to have the same window size.
-    This function checks if the window sizes are equal and exits if they are not
+    Pool task wrapper of scan_tsv_file
     """
-    window_sizes = dict()
-    for tsv_file in df_dict:
-        window_size = detect_window_size(df_dict[tsv_file], tsv_file)
-        window_sizes[tsv_file] = window_size
-    if len(set(window_sizes.values())) > 1:
-        sys.stderr.write("The input TSV files appear to have different window sizes.\n")
-        for tsv_file in window_sizes:
-            sys.stderr.write("{}: window size {} bp\n".format(tsv_file, window_sizes[tsv_file]))
-        sys.exit(1)
-
+    return scan_tsv_file(*task)
 
-def main(tsv_files):
 
-    for tsv_file in tsv_files:
-        validate_tsv(tsv_file)
+def main(tsv_files, workers, temp_dir, report_file):
+    report = ValidationReport()
+    tsv_files = check_duplicate_files(report, tsv_files)
 
-    df_dict = OrderedDict()
+    columns_dict = dict()
     for tsv_file in tsv_files:
-        df = pd.read_csv(tsv_file, sep="\t")
-        if tsv_file not in df_dict:
-            df_dict[tsv_file] = df
+        df_colnames = read_tsv_header(tsv_file, report)
+        if df_colnames is not None:
+            columns_dict[tsv_file] = df_colnames
+
+    # The files that could be opened are still read for the other checks, so that the report has all problems of the input files
+    output_columns = check_noncommon_columns(report, columns_dict) if len(columns_dict) > 0 else list()
+    readable_files = list(columns_dict)
+
+    with tempfile.TemporaryDirectory(dir=temp_dir) as tmp_folder:
+        tasks = [(tsv_file, columns_dict[tsv_file], output_columns, "{}/{}.tsv".format(tmp_folder, i)) for (i, tsv_file) in enumerate(readable_files)]
+        if workers > 1 and len(tasks) > 1:
+            with Pool(min(workers, len(tasks))) as pool:
+                results = pool.map(scan_tsv_file_task, tasks, chunksize=1)
         else:
-            sys.stderr.write("The input file {} appears in the input more than once\n".format(tsv_file))
+            results = [scan_tsv_file_task(task) for task in tasks]
+
+        window_steps_dict = dict()
+        entries_dict = dict()
+        for (tsv_file, (summary, error)) in zip(readable_files, results):
+            if error is not None:
+                report.add("input_file", "Failed to parse the input file {} as a TSV (tab separated values) file:\n{}".format(tsv_file, error.rstrip()), tsv_file)
+                continue
+            window_steps_dict[tsv_file] = summary["window_steps"]
+            entries_dict[tsv_file] = summary["entries"]
+
+        check_window_sizes(report, window_steps_dict)
+        check_duplicate_entries(report, entries_dict)
+
+        report.write(sys.stderr)
+        if report_file is not None:
+            report.write_json(report_file)
+        if report.has_errors():
             sys.exit(1)
 
-    check_for_noncommon_columns(df_dict)
-    check_window_sizes(df_dict)
-    check_for_duplicate_entries(df_dict)
-    
-    concat_df = pd.concat(list(df_dict.values()), join="inner", ignore_index=True, sort=False)
-    concat_df.to_csv(sys.stdout, index=False, sep="\t", header=True)
+        pd.DataFrame(columns=output_columns).to_csv(sys.stdout, index=False, sep="\t", header=True)
+        sys.stdout.flush()
+        for task in tasks:
+            with open(task[3], "rb") as f:
+                shutil.copyfileobj(f, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("tsv_files", type=str, nargs="+", default=[], help="Path(s) to the TSV file(s)")
+    parser.add_argument("tsv_files", type=str, nargs="+", default=[], help="Path(s) to the TSV file(s) or columnar tracks folder(s)")
+    parser.add_argument("--workers", type=int, help="Number of input files that are read in parallel (default: 1)", default=1)
+    parser.add_argument("--temp_dir", type=str, help="Folder for the temporary files, which take as much space as the output (default: the system temporary folder)", default=None)
+    parser.add_argument("--report", type=str, help="Path for a JSON file with all problems found by the checks of the input files (default: the problems are only written to STDERR)", default=None)
     args = parser.parse_args()
-    main(args.tsv_files)
\ No newline at end of file
+    main(args.tsv_files, args.workers, args.temp_dir, args.report)
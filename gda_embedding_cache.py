@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+On-disk cache of UMAP embeddings for GDA clustering runs.
+Embeddings are stored as .npy files named after a hash of the scaled feature matrix and the UMAP parameters,
+so that reruns with different HDBSCAN or p-value settings can skip UMAP
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import os
+import hashlib
+import numpy as np
+
+
+class EmbeddingCache():
+    ''' Content-addressed cache of UMAP embeddings in a folder, with least recently used files evicted when the cache grows above max_size_mb'''
+    def __init__(self, cache_dir, max_size_mb=2000):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def get_key(scaled_data, **umap_params):
+        '''Returns a hash of the scaled feature matrix and the UMAP parameters (n_neighbors, min_dist, metric, random_state etc.)'''
+        scaled_data = np.ascontiguousarray(scaled_data)
+        h = hashlib.sha256()
+        h.update(str(scaled_data.shape).encode())
+        h.update(str(scaled_data.dtype).encode())
+        h.update(scaled_data.data)
+        for param_name in sorted(umap_params):
+            h.update('{}={};'.format(param_name, umap_params[param_name]).encode())
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return self.cache_dir + '/umap_embedding_' + key + '.npy'
+
+    def contains(self, key):
+        '''Returns True if an embedding with this key is in the cache'''
+        return os.path.isfile(self.get_path(key))
+
+    def load(self, key):
+        '''Returns the cached embedding as a read-only memory-mapped array, or None if it is not in the cache'''
+        path = self.get_path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            embedding = np.load(path, mmap_mode='r')
+            # The modification time records when the file was last used, for LRU eviction
+            os.utime(path)
+        except (ValueError, OSError) as e:
+            sys.stderr.write("Ignoring unreadable cached UMAP embedding {}: {}\n".format(path, str(e)))
+            return None
+        return embedding
+
+    def store(self, key, embedding):
+        '''Saves an embedding in the cache and evicts the least recently used embeddings if the cache is too large'''
+        path = self.get_path(key)
+        tmp_path = path + '.tmp.{}'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(embedding))
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        '''Removes least recently used embeddings until the total size of the cache is below the size limit. The file at the path "keep" is not removed'''
+        cached_files = list()
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith('umap_embedding_') and filename.endswith('.npy'):
+                path = self.cache_dir + '/' + filename
+                # Files can be removed by other processes that use the same cache (e.g. gda_parameters.py --jobs)
+                try:
+                    file_stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                cached_files.append((file_stat.st_mtime, file_stat.st_size, path))
+        total_size = sum([x[1] for x in cached_files])
+        for (mtime, size, path) in sorted(cached_files):
+            if total_size <= self.max_size_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Feature enrichment tests for GDA clusters.
+Each feature column is sorted once and the one-sided two-sample Kolmogorov-Smirnov statistics of all clusters are
+computed from cumulative rank counts, instead of running scipy's ks_2samp separately for every cluster and feature
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from math import gcd
+from multiprocessing import Pool, shared_memory
+import warnings
+import numpy as np
+import pandas as pd
+
+# The exact distribution of the KS statistic is taken from scipy so that the p-values are the same as the ones from ks_2samp
+try:
+    from scipy.stats._stats_py import _attempt_exact_2kssamp
+except ImportError:
+    from scipy.stats.stats import _attempt_exact_2kssamp
+
+NON_FEATURE_COLUMNS = ('species', 'cluster', 'start', 'end', 'chromosome')
+FEATURE_TABLE_COLUMNS = ['cluster', 'feature', 'cluster_data.size', 'other_data.size', 'stat_less', 'pvalue_less', 'stat_great', 'pvalue_great', 'cluster_median', 'other_median', 'cluster_mean', 'other_mean', 'ks_mode_less', 'ks_mode_great']
+
+KS_MODES = ('exact', 'asymp', 'auto')
+# In the "auto" KS mode, exact p-values are calculated when the larger sample is at most this size (same limit as scipy's ks_2samp mode="auto")
+KS_AUTO_MAX_EXACT_N = 10000
+# In the "auto" KS mode, tests with asymptotic p-values within this factor of the p-value cutoff are recalculated with the exact distribution
+KS_AUTO_BOUNDARY_FACTOR = 100
+
+
+def get_feature_columns(data):
+    '''Returns the names of the columns of the GDA tracks data frame that contain feature values'''
+    return [f for f in data.columns if f not in NON_FEATURE_COLUMNS]
+
+
+def get_feature_values_dtype(data, feature_columns):
+    '''Returns the dtype in which the feature values are tested: float32 if all feature columns are float32 (as read by gda_clustering.py --low_memory), otherwise float64.
+    Converting float32 values to float64 does not change their order, so the KS statistics are the same in both dtypes'''
+    if len(feature_columns) > 0 and all(data[f].dtype == np.float32 for f in feature_columns):
+        return np.float32
+    return np.float64
+
+
+def ks_asymp_pvalue(d, n1, n2):
+    '''Returns the one-sided p-value of the KS statistic d for samples of sizes n1 and n2 from Hodges' approximation, as in ks_2samp(mode="asymp")'''
+    # The approximation requires m to be the larger of (n1, n2)
+    m, n = sorted([float(n1), float(n2)], reverse=True)
+    en = m * n / (m + n)
+    z = np.sqrt(en) * d
+    expt = -2 * z**2 - 2 * z * (m + 2*n)/np.sqrt(m*n*(m+n))/3.0
+    return np.clip(np.exp(expt), 0, 1)
+
+
+def ks_2samp_from_statistic(d, n1, n2, alternative):
+    '''Returns the (statistic, pvalue, mode) that scipy.stats.ks_2samp(data1, data2, alternative=alternative, mode="exact") would use
+    for samples of sizes n1 and n2 whose maximum ECDF difference is d. The mode is "asymp" if the exact calculation was not possible'''
+    g = gcd(n1, n2)
+    # If lcm(n1, n2) is too big, ks_2samp switches from exact to asymp
+    if (n1 // g) >= np.iinfo(np.int_).max / (n2 // g):
+        return (d, ks_asymp_pvalue(d, n1, n2), 'asymp')
+    success, d, prob = _attempt_exact_2kssamp(n1, n2, g, d, alternative)
+    if not success:
+        warnings.warn('ks_2samp: Exact calculation unsuccessful. Switching to mode=asymp.', RuntimeWarning)
+        return (d, ks_asymp_pvalue(d, n1, n2), 'asymp')
+    return (d, np.clip(prob, 0, 1), 'exact')
+
+
+def ks_pvalue(d, n1, n2, alternative, ks_mode, pvalue_cutoff, pvalue_cache):
+    '''Returns the (statistic, pvalue, mode) of a one-sided KS test using the selected ks_mode ("exact", "asymp" or "auto").
+    In "auto" mode the asymptotic distribution is used if the larger sample has more than KS_AUTO_MAX_EXACT_N windows,
+    unless the asymptotic p-value is within KS_AUTO_BOUNDARY_FACTOR of pvalue_cutoff, in which case the exact p-value is calculated.
+    Sizes of the clusters are the same for every feature, so p-values of identical statistics are looked up from pvalue_cache'''
+    key = (n1, n2, d, alternative)
+    if key in pvalue_cache:
+        return pvalue_cache[key]
+    if ks_mode == 'asymp':
+        result = (d, ks_asymp_pvalue(d, n1, n2), 'asymp')
+    elif ks_mode == 'auto' and max(n1, n2) > KS_AUTO_MAX_EXACT_N:
+        asymp_pvalue = ks_asymp_pvalue(d, n1, n2)
+        if pvalue_cutoff / KS_AUTO_BOUNDARY_FACTOR <= asymp_pvalue <= pvalue_cutoff * KS_AUTO_BOUNDARY_FACTOR:
+            result = ks_2samp_from_statistic(d, n1, n2, alternative)
+        else:
+            result = (d, asymp_pvalue, 'asymp')
+    else:
+        result = ks_2samp_from_statistic(d, n1, n2, alternative)
+    pvalue_cache[key] = result
+    return result
+
+
+def ks_statistics_per_cluster(values, codes, n_clusters):
+    '''Sorts the values of one feature once and returns arrays of one-sided KS statistics (stat_less, stat_great) for each cluster code versus all other windows.
+    The statistics are the same as those from ks_2samp(other_data, cluster_data, alternative="less"/"greater")'''
+    order = np.argsort(values, kind='mergesort')
+    sorted_values = values[order]
+    sorted_codes = codes[order]
+    # The ECDFs only need to be compared at the last position of each run of tied values
+    group_ends = np.flatnonzero(np.append(sorted_values[1:] != sorted_values[:-1], True))
+    total_counts = group_ends + 1
+    n_total = len(values)
+
+    stat_less = np.zeros(n_clusters)
+    stat_great = np.zeros(n_clusters)
+    for k in range(n_clusters):
+        cluster_counts = np.cumsum(sorted_codes == k)[group_ends]
+        n_cluster = cluster_counts[-1]
+        cdf_cluster = cluster_counts / n_cluster
+        cdf_other = (total_counts - cluster_counts) / (n_total - n_cluster)
+        cddiffs = cdf_other - cdf_cluster
+        stat_less[k] = max(0.0, -np.min(cddiffs))
+        stat_great[k] = np.max(cddiffs)
+    return (stat_less, stat_great)
+
+
+def run_feature_tests(values, index_order, codes, cluster_sizes, ks_mode, pvalue_cutoff, pvalue_cache):
+    '''Runs the enrichment tests of one feature for all clusters. Returns a list with one tuple of test results per cluster'''
+    n_clusters = len(cluster_sizes)
+    n_total = len(values)
+    (stat_less, stat_great) = ks_statistics_per_cluster(values, codes, n_clusters)
+    # The windows outside the cluster are taken in the order of the sorted window names, as with data.index.difference()
+    values_by_name = values[index_order]
+    codes_by_name = codes[index_order]
+
+    feature_results = list()
+    for k in range(n_clusters):
+        n_cluster = int(cluster_sizes[k])
+        n_other = n_total - n_cluster
+        (d_less, pvalue_less, mode_less) = ks_pvalue(stat_less[k], n_other, n_cluster, 'less', ks_mode, pvalue_cutoff, pvalue_cache)
+        (d_great, pvalue_great, mode_great) = ks_pvalue(stat_great[k], n_other, n_cluster, 'greater', ks_mode, pvalue_cutoff, pvalue_cache)
+
+        # Medians and means are calculated in float64 also for float32 feature values
+        cluster_data = values[codes == k].astype(np.float64, copy=False)
+        other_data = values_by_name[codes_by_name != k].astype(np.float64, copy=False)
+        feature_results.append((n_cluster, n_other, d_less, pvalue_less, d_great, pvalue_great, np.median(cluster_data), np.median(other_data), np.mean(cluster_data), np.mean(other_data), mode_less, mode_great))
+    return feature_results
+
+
+# Per-process state of the enrichment test workers. The feature matrix is attached from shared memory when a worker starts
+_worker_state = dict()
+
+
+def init_feature_test_worker(shm_name, matrix_shape, matrix_dtype, index_order, codes, cluster_sizes, ks_mode, pvalue_cutoff):
+    '''Attaches a pool worker to the shared feature matrix (one row per feature)'''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_state['shm'] = shm
+    _worker_state['matrix'] = np.ndarray(matrix_shape, dtype=matrix_dtype, buffer=shm.buf)
+    _worker_state['index_order'] = index_order
+    _worker_state['codes'] = codes
+    _worker_state['cluster_sizes'] = cluster_sizes
+    _worker_state['ks_mode'] = ks_mode
+    _worker_state['pvalue_cutoff'] = pvalue_cutoff
+    _worker_state['pvalue_cache'] = dict()
+
+
+def run_feature_tests_in_worker(feature_number):
+    '''Runs the enrichment tests of one row of the shared feature matrix in a pool worker'''
+    return run_feature_tests(_worker_state['matrix'][feature_number], _worker_state['index_order'], _worker_state['codes'], _worker_state['cluster_sizes'], _worker_state['ks_mode'], _worker_state['pvalue_cutoff'], _worker_state['pvalue_cache'])
+
+
+def run_feature_tests_in_pool(data, feature_columns, index_order, codes, cluster_sizes, ks_mode, pvalue_cutoff, workers):
+    '''Runs the enrichment tests over a process pool, one feature (with all of its clusters) per task.
+    The feature matrix is copied once into shared memory (in the dtype from get_feature_values_dtype) instead of being pickled to each worker. Returns a dict of feature -> test results'''
+    matrix_shape = (len(feature_columns), len(data.index))
+    matrix_dtype = get_feature_values_dtype(data, feature_columns)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, matrix_shape[0] * matrix_shape[1] * np.dtype(matrix_dtype).itemsize))
+    try:
+        matrix = np.ndarray(matrix_shape, dtype=matrix_dtype, buffer=shm.buf)
+        for i, f in enumerate(feature_columns):
+            matrix[i] = data[f].to_numpy(dtype=matrix_dtype)
+        with Pool(workers, initializer=init_feature_test_worker, initargs=(shm.name, matrix_shape, matrix_dtype, index_order, codes, cluster_sizes, ks_mode, pvalue_cutoff)) as pool:
+            # Pool.map returns the results in the order of the features, so the output does not depend on the number of workers
+            feature_results = pool.map(run_feature_tests_in_worker, range(len(feature_columns)), chunksize=1)
+        del matrix
+    finally:
+        shm.close()
+        shm.unlink()
+    return dict(zip(feature_columns, feature_results))
+
+
+def get_significant_features(data, pvalue_cutoff, workers=1, ks_mode='exact'):
+    '''Get significant features in each cluster and determine proportions of each cluster in each species.
+    Returns the set of significant features, a data frame of significant feature stats per cluster, a dict of cluster proportions per species and a dict of cluster means per feature.
+    If workers is more than 1, the features are tested in parallel over a process pool. ks_mode selects how KS p-values are calculated (see ks_pvalue)'''
+    cluster_list = sorted(set(data['cluster'].tolist()))
+    codes = np.searchsorted(cluster_list, data['cluster'].to_numpy())
+    cluster_sizes = np.bincount(codes, minlength=len(cluster_list))
+    index_order = data.index.argsort()
+
+    # Proportion of each species' genome made up by each cluster
+    (species_list, species_codes) = np.unique(data['species'].to_numpy(dtype=str), return_inverse=True)
+    species_counts = np.bincount(codes * len(species_list) + species_codes, minlength=len(cluster_list) * len(species_list)).reshape(len(cluster_list), len(species_list))
+    species_totals = species_counts.sum(axis=0)
+    cluster_species_genome_prop = dict()
+    for k, c in enumerate(cluster_list):
+        cluster_species_genome_prop[c] = dict()
+        for j, s in enumerate(species_list.tolist()):
+            cluster_species_genome_prop[c][s] = (int(species_counts[k, j]) * 100) / int(species_totals[j])
+
+    feature_columns = get_feature_columns(data)
+    if workers > 1 and len(feature_columns) > 1:
+        results = run_feature_tests_in_pool(data, feature_columns, index_order, codes, cluster_sizes, ks_mode, pvalue_cutoff, workers)
+    else:
+        values_dtype = get_feature_values_dtype(data, feature_columns)
+        pvalue_cache = dict()
+        results = dict()
+        for f in feature_columns:
+            results[f] = run_feature_tests(data[f].to_numpy(dtype=values_dtype), index_order, codes, cluster_sizes, ks_mode, pvalue_cutoff, pvalue_cache)
+
+    (sig_features, cluster_results_df, cluster_means) = collect_feature_results(results, cluster_list, feature_columns, pvalue_cutoff)
+    return (sig_features, cluster_results_df, cluster_species_genome_prop, cluster_means)
+
+
+def collect_feature_results(results, cluster_list, feature_columns, pvalue_cutoff):
+    '''Assembles per-feature test results into the set of significant features, the feature table and the cluster means, in cluster then feature order'''
+    sig_features = set()
+    cluster_means = dict() # This is used for heatmap
+    table_rows = list()
+    for f in feature_columns:
+        cluster_means[f] = dict()
+    for k, c in enumerate(cluster_list):
+        for f in feature_columns:
+            (cluster_size, other_size, stat_less, pvalue_less, stat_great, pvalue_great, cluster_median, other_median, cluster_mean, other_mean, mode_less, mode_great) = results[f][k]
+            cluster_means[f][c] = cluster_mean
+            if pvalue_less <= pvalue_cutoff or pvalue_great <= pvalue_cutoff:
+                sig_features.add(f)
+                table_rows.append([c, f, cluster_size, other_size, '{:.2f}'.format(stat_less), '{:.2e}'.format(pvalue_less), '{:.2f}'.format(stat_great), '{:.2e}'.format(pvalue_great), '{:.5f}'.format(cluster_median), '{:.5f}'.format(other_median), '{:.5f}'.format(cluster_mean), '{:.5f}'.format(other_mean), mode_less, mode_great])
+    cluster_results_df = pd.DataFrame(table_rows, columns=FEATURE_TABLE_COLUMNS)
+    return (sig_features, cluster_results_df, cluster_means)
@@ -32,6 +32,7 @@ It will report the resulting clusters allowing the user to select parameters for
 import argparse
 import sys
 import os
+import json
 import pandas as pd
 from sklearn.preprocessing import MinMaxScaler
 import umap
@@ -39,10 +40,13 @@ import hdbscan
 import matplotlib.pyplot as plt
 import spectra
 import numpy as np
-from matplotlib.colors import ListedColormap
+from matplotlib.colors import ListedColormap, to_rgb
+from matplotlib.lines import Line2D
+from multiprocessing import Pool
 
-from gda_clustering import get_palette, run_umap, run_hdbscan, check_umap_version
-from sklearn import metrics
+from gda_clustering import get_palette, scale_data, run_umap_on_scaled_data, run_hdbscan_sweep, check_umap_version, get_embedding_cache, read_tracks, NearestNeighbourGraph, uses_knn_graph, get_umap_cache_key
+from gda_clustering_metrics import EmbeddingMetrics, SILHOUETTE_SAMPLE_SIZE
+from gda_embedding_cache import EmbeddingCache
 
 # Ignore NUMBA warnings related to running UMAP
 import warnings
@@ -55,6 +59,12 @@ warnings.filterwarnings("ignore", category=NumbaWarning)
 # Ignore matplotlib's "More than 20 figures have been opened" warning
 plt.rcParams.update({'figure.max_open_warning': 0})
 
+PLOT_STYLES = ('density', 'scatter')
+# Width and height in pixels of the grid that UMAP embeddings are drawn on in the density plots
+PLOT_RASTER_SIZE = 250
+# Margin around the embedding in the density plots, as a fraction of the range of the embedding (same as the default margin of matplotlib scatter plots)
+PLOT_MARGIN = 0.05
+
 
 
 ###############
@@ -80,7 +90,10 @@ def print_clustering_result(n, c, cluster_labels, metrics_dict_entry):
 
     silhouette_score = metrics_dict_entry["silhouette_score"]
     if silhouette_score is not None:
-        print("Silhouette score: {:.2f}".format(silhouette_score))
+        if metrics_dict_entry["silhouette_score_ci_lower"] < metrics_dict_entry["silhouette_score_ci_upper"]:
+            print("Silhouette score: {:.2f} (95% confidence interval {:.2f} to {:.2f}, estimated from {} windows)".format(silhouette_score, metrics_dict_entry["silhouette_score_ci_lower"], metrics_dict_entry["silhouette_score_ci_upper"], metrics_dict_entry["silhouette_sample_size"]))
+        else:
+            print("Silhouette score: {:.2f}".format(silhouette_score))
         print("Davies-Bouldin index: {:.2f}".format(metrics_dict_entry["davies_bouldin_index"]))
         print("Calinski-Harabasz score: {:.2f}".format(metrics_dict_entry["calinski_harabasz_score"]))
     print()
@@ -188,6 +201,197 @@ def export_metrics_table(metrics_dict, outdir_full):
     
 
 
+class SweepCheckpoints():
+    ''' Results of the completed (n_neighbors, min cluster size) cells of a parameter sweep. The metrics of each cell and its cluster labels
+    are saved in checkpoint_dir as soon as the cell is done, so that a rerun of an interrupted sweep only runs the missing cells.
+    sweep_key identifies the input data and the settings that the results depend on, cells saved with another key are run again'''
+    def __init__(self, checkpoint_dir, sweep_key):
+        self.checkpoint_dir = checkpoint_dir
+        self.sweep_key = sweep_key
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+    def get_path(self, n, c):
+        return '{}/cell_n{}_c{}'.format(self.checkpoint_dir, n, c)
+
+    def load(self, n, c):
+        '''Returns the saved result of a cell, or None if the cell has not been completed with the current input and settings'''
+        path = self.get_path(n, c) + '.json'
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (ValueError, OSError) as e:
+            sys.stderr.write("Ignoring unreadable checkpoint {}: {}\n".format(path, str(e)))
+            return None
+        if result.get('sweep_key') != self.sweep_key or not os.path.isfile(result['plot_file']) or not os.path.isfile(self.get_path(n, c) + '_labels.npy'):
+            return None
+        del result['sweep_key']
+        # JSON keys are strings
+        result['cluster_props'] = {int(x): result['cluster_props'][x] for x in result['cluster_props']}
+        return result
+
+    def store(self, result, cluster_labels):
+        '''Saves the result of a cell and its cluster labels. The metrics are written last, so a cell only counts as completed once all of its files are saved'''
+        path = self.get_path(result['n'], result['c'])
+        labels_dtype = np.int16 if max(cluster_labels) <= np.iinfo(np.int16).max else np.int32
+        with open(path + '_labels.npy.tmp', 'wb') as f:
+            np.save(f, np.asarray(cluster_labels, dtype=labels_dtype))
+        os.replace(path + '_labels.npy.tmp', path + '_labels.npy')
+        checkpoint = dict(result, sweep_key=self.sweep_key, cluster_props={str(x): result['cluster_props'][x] for x in result['cluster_props']})
+        with open(path + '.json.tmp', 'w') as f:
+            f.write(json.dumps(checkpoint, indent=1))
+        os.replace(path + '.json.tmp', path + '.json')
+
+
+def get_sweep_key(scaled_data, knn_graph, args):
+    '''Returns a hash of the scaled feature values and the settings that the results of the parameter sweep cells depend on'''
+    knn_n_neighbors = None
+    if uses_knn_graph(scaled_data, knn_graph):
+        # The UMAP embeddings depend on the number of neighbours in the shared nearest neighbour graph
+        knn_n_neighbors = knn_graph.n_neighbors
+    return EmbeddingCache.get_key(scaled_data, knn_n_neighbors=knn_n_neighbors, umap_version=umap.__version__, leaf_size=args.leaf_size, min_samples=args.min_samples,
+                                  silhouette_sample_size=args.silhouette_sample_size, plot_style=args.plot_style)
+
+
+# Per-process state of the parameter sweep workers
+_worker_state = dict()
+
+
+def init_sweep_worker(scaled_data, knn_graph, embedding_cache, checkpoints, cluster_size_list, leaf_size, min_samples, silhouette_sample_size, plot_style, outdir_full):
+    '''Sets the data and settings that are shared by all n_neighbors values of the parameter sweep'''
+    _worker_state['scaled_data'] = scaled_data
+    _worker_state['knn_graph'] = knn_graph
+    _worker_state['embedding_cache'] = embedding_cache
+    _worker_state['checkpoints'] = checkpoints
+    _worker_state['cluster_size_list'] = cluster_size_list
+    _worker_state['leaf_size'] = leaf_size
+    _worker_state['min_samples'] = min_samples
+    _worker_state['silhouette_sample_size'] = silhouette_sample_size
+    _worker_state['plot_style'] = plot_style
+    _worker_state['outdir_full'] = outdir_full
+
+
+def get_plot_palette(cluster_labels):
+    '''Returns the colours of the clusters in the UMAP plots, from the lowest to the highest cluster label. Unclassified windows (label -1) are grey'''
+    palette = get_palette(max(cluster_labels) + 1)
+    if -1 in cluster_labels:
+        palette.insert(0, "#B3B4B5")
+    return palette
+
+
+def plot_clustering(embedding, cluster_labels, outfile):
+    '''Saves a UMAP plot coloured by cluster, with a dot for each window'''
+    cmap1 = ListedColormap(get_plot_palette(cluster_labels))
+
+    (fig, ax) = plt.subplots()
+    scatter = ax.scatter(embedding[:,0], embedding[:,1], c=cluster_labels, cmap=cmap1, s=0.3)
+
+    # Shrink current axis by 20%
+    box = ax.get_position()
+    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+
+    legend1 = ax.legend(*scatter.legend_elements(),
+                loc="center left", title="Clusters", bbox_to_anchor=(1, 0.5))
+    ax.add_artist(legend1)
+
+    plt.savefig(outfile)
+    plt.close(fig)
+
+
+class EmbeddingRaster():
+    ''' Grid of pixels over a UMAP embedding, for drawing the embedding as an image instead of a dot for each window.
+    The pixel of each window is found once per embedding and shared by the plots of all min cluster sizes'''
+    def __init__(self, embedding, size=PLOT_RASTER_SIZE):
+        self.size = size
+        embedding_min = embedding.min(axis=0)
+        embedding_max = embedding.max(axis=0)
+        self.extent = (embedding_min[0], embedding_max[0], embedding_min[1], embedding_max[1])
+        embedding_span = np.where(embedding_max > embedding_min, embedding_max - embedding_min, 1)
+        pixel_coordinates = np.minimum(((embedding - embedding_min) / embedding_span * size).astype(np.int64), size - 1)
+        self.pixel_indices = pixel_coordinates[:, 1] * size + pixel_coordinates[:, 0]
+        self.window_counts = np.bincount(self.pixel_indices, minlength=size * size)
+
+    def get_image(self, window_colours):
+        '''Returns an RGBA image (size x size x 4 array) where the colour of each pixel is the mean of the RGB colours (windows x 3 array) of its windows.
+        Pixels without windows are transparent'''
+        image = np.zeros((self.size * self.size, 4))
+        has_windows = self.window_counts > 0
+        for i in range(3):
+            colour_sums = np.bincount(self.pixel_indices, weights=window_colours[:, i], minlength=self.size * self.size)
+            image[has_windows, i] = colour_sums[has_windows] / self.window_counts[has_windows]
+        image[has_windows, 3] = 1
+        return image.reshape(self.size, self.size, 4)
+
+
+def plot_clustering_density(embedding_raster, cluster_labels, outfile):
+    '''Saves a UMAP plot coloured by cluster, drawn as an image of an EmbeddingRaster. The colour of each pixel is the mean colour of the clusters of its windows,
+    so the time needed for drawing the plot does not depend on the number of windows'''
+    palette = get_plot_palette(cluster_labels)
+    palette_rgb = np.array([to_rgb(x) for x in palette])
+    min_label = min(cluster_labels)
+    image = embedding_raster.get_image(palette_rgb[cluster_labels - min_label])
+
+    (fig, ax) = plt.subplots()
+    ax.imshow(image, origin='lower', extent=embedding_raster.extent, aspect='auto', interpolation='nearest')
+    # Same margins around the embedding as in the scatter plots
+    (x_min, x_max, y_min, y_max) = embedding_raster.extent
+    ax.set_xlim(x_min - PLOT_MARGIN * (x_max - x_min), x_max + PLOT_MARGIN * (x_max - x_min))
+    ax.set_ylim(y_min - PLOT_MARGIN * (y_max - y_min), y_max + PLOT_MARGIN * (y_max - y_min))
+
+    # Shrink current axis by 20%
+    box = ax.get_position()
+    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+
+    legend_handles = [Line2D([0], [0], marker='o', linestyle='', color=colour, label=str(label)) for (label, colour) in zip(range(min_label, min_label + len(palette)), palette)]
+    ax.legend(handles=legend_handles, loc="center left", title="Clusters", bbox_to_anchor=(1, 0.5))
+
+    plt.savefig(outfile)
+    plt.close(fig)
+
+
+def run_sweep_for_n_neighbors(n):
+    '''Runs UMAP with n neighbours, then HDBSCAN, clustering metrics and a UMAP plot for each min cluster size.
+    Min cluster sizes that have been completed in an earlier run of the sweep are loaded from the checkpoints. Returns a list of dicts with the results of each min cluster size'''
+    checkpoints = _worker_state['checkpoints']
+    saved_results = {c: checkpoints.load(n, c) for c in _worker_state['cluster_size_list']}
+    missing_cluster_sizes = [c for c in _worker_state['cluster_size_list'] if saved_results[c] is None]
+    if len(missing_cluster_sizes) < len(_worker_state['cluster_size_list']):
+        sys.stderr.write("Loaded the results of {} min cluster size(s) with {} neighbours from checkpoints\n".format(len(_worker_state['cluster_size_list']) - len(missing_cluster_sizes), n))
+    if len(missing_cluster_sizes) == 0:
+        return [saved_results[c] for c in _worker_state['cluster_size_list']]
+
+    # Get UMAP embedding for the data
+    embedding = run_umap_on_scaled_data(_worker_state['scaled_data'], n, embedding_cache=_worker_state['embedding_cache'], knn_graph=_worker_state['knn_graph'])
+
+    # Run HDBSCAN for all cluster window sizes
+    cluster_labels_dict = run_hdbscan_sweep(embedding, _worker_state['leaf_size'], _worker_state['min_samples'], missing_cluster_sizes)
+
+    # Calculate Silhouette score, Davies-Bouldin index and Calinski-Harabasz score to assess how well clustering with the selected settings has worked.
+    # The distances between windows that the silhouette scores need are calculated once for all cluster window sizes
+    embedding_metrics = EmbeddingMetrics(embedding, sample_size=_worker_state['silhouette_sample_size'])
+    clustering_metrics_list = embedding_metrics.clustering_metrics([cluster_labels_dict[c] for c in missing_cluster_sizes])
+
+    if _worker_state['plot_style'] == 'density':
+        embedding_raster = EmbeddingRaster(embedding)
+
+    for (c, clustering_metrics) in zip(missing_cluster_sizes, clustering_metrics_list):
+        cluster_labels = cluster_labels_dict[c]
+        cluster_props = get_cluster_props(cluster_labels)
+        metrics_dict_entry = {"n_neighbors": n, "min_cluster_size": c, "silhouette_score": clustering_metrics["silhouette_score"], "unclassified_percentage": cluster_props[-1], "davies_bouldin_index": clustering_metrics["davies_bouldin_index"], "calinski_harabasz_score": clustering_metrics["calinski_harabasz_score"],
+                              "silhouette_score_ci_lower": clustering_metrics["silhouette_score_ci_lower"], "silhouette_score_ci_upper": clustering_metrics["silhouette_score_ci_upper"], "silhouette_sample_size": clustering_metrics["silhouette_sample_size"]}
+
+        outfile = '{}/umap_clustering_n{}_c{}.png'.format(_worker_state['outdir_full'], n, c)
+        if _worker_state['plot_style'] == 'density':
+            plot_clustering_density(embedding_raster, cluster_labels, outfile)
+        else:
+            plot_clustering(embedding, cluster_labels, outfile)
+        saved_results[c] = {"n": n, "c": c, "cluster_props": cluster_props, "metrics": metrics_dict_entry, "plot_file": outfile}
+        checkpoints.store(saved_results[c], cluster_labels)
+    return [saved_results[c] for c in _worker_state['cluster_size_list']]
+
+
 def main(args):
     #################
     # Procedural code
@@ -203,14 +407,10 @@ def main(args):
     set_up_outdir(outdir)
     outdir_full = outdir + '/parameter_selection'
 
-    # Read in GDA data tracks as pandas data frame
-    data = pd.read_csv(tracks_file, sep='\t', index_col=0)
+    # Read in GDA data tracks as pandas data frame, without N-containing windows
+    data = read_tracks(tracks_file)
     data = filter_df_to_keep_selected_scaff(args.selected_scaff_only, data)
 
-    # Filter windows remove any N-containing windows
-    if 'N_percentage' in data.columns:
-        data.drop(index=data[data.N_percentage>0].index, axis=0, inplace=True)
-
     # Make a dataframe with only window_name index and feature values suitable for clustering
     data_to_cluster = data.drop(['species', 'start', 'end', 'chromosome'], axis=1)
 
@@ -224,65 +424,48 @@ def main(args):
 
     metrics_dict = dict()
 
-    # Loop over n_neighbours values and run UMAP
-    for n in neighbours_list:
-
-        # Get UMAP embedding for the data
-        embedding = run_umap(data_to_cluster, n)
+    embedding_cache = get_embedding_cache(args.embedding_cache_dir, args.embedding_cache_size, outdir)
 
-        # Loop over cluster window sizes and run HDBSCAN
-        for c in cluster_size_list:
-            cluster_labels = run_hdbscan(embedding, args.leaf_size, args.min_samples, min_cluster_size=c)
+    # The nearest neighbours of each window are found once, at the largest n_neighbors value, and used by the UMAP runs of all n_neighbors values
+    scaled_data = scale_data(data_to_cluster)
+    knn_graph = NearestNeighbourGraph(scaled_data, max(neighbours_list))
 
-            # Calculate Silhouette score, Davies-Bouldin index and Calinski-Harabasz score to assess how well clustering with the selected settings has worked
-            silhouette_score = None
-            davies_bouldin_index = None
-            calinski_harabasz_score = None
+    # Results of each parameter pair are saved as soon as they are done, and loaded instead of running the pair again if the sweep is rerun
+    checkpoints = SweepCheckpoints(outdir_full + '/checkpoints', get_sweep_key(scaled_data, knn_graph, args))
+    pending_neighbours_list = [n for n in neighbours_list if any([checkpoints.load(n, c) is None for c in cluster_size_list])]
 
-            if len(set(cluster_labels)) > 1:
-                silhouette_score = metrics.silhouette_score(embedding, cluster_labels)
-                davies_bouldin_index = metrics.davies_bouldin_score(embedding, cluster_labels)
-                calinski_harabasz_score = metrics.calinski_harabasz_score(embedding, cluster_labels)
-
-            cluster_props = get_cluster_props(cluster_labels)
+    sweep_settings = (scaled_data, knn_graph, embedding_cache, checkpoints, cluster_size_list, args.leaf_size, args.min_samples, args.silhouette_sample_size, args.plot_style, outdir_full)
+    if args.jobs > 1 and len(pending_neighbours_list) > 1:
+        # The nearest neighbour graph is found before the workers start, so that each worker does not search for it again
+        if uses_knn_graph(scaled_data, knn_graph) and (embedding_cache is None or not all([embedding_cache.contains(get_umap_cache_key(embedding_cache, scaled_data, n, knn_graph=knn_graph)) for n in pending_neighbours_list])):
+            knn_graph.get(knn_graph.n_neighbors)
+        # Each worker runs UMAP for one n_neighbors value and then HDBSCAN for all min cluster sizes. Pool.map returns the results in the order of neighbours_list
+        with Pool(min(args.jobs, len(pending_neighbours_list)), initializer=init_sweep_worker, initargs=sweep_settings) as pool:
+            sweep_results = pool.map(run_sweep_for_n_neighbors, neighbours_list, chunksize=1)
+    else:
+        init_sweep_worker(*sweep_settings)
+        sweep_results = [run_sweep_for_n_neighbors(n) for n in neighbours_list]
 
+    # Collect the results of all parameter pairs
+    for n_results in sweep_results:
+        for result in n_results:
+            (n, c) = (result["n"], result["c"])
             if n not in all_cluster_props:
                 all_cluster_props[n] = dict()
-            all_cluster_props[n][c] = cluster_props
+            all_cluster_props[n][c] = result["cluster_props"]
 
             if n not in silhouette_scores:
                 silhouette_scores[n] = dict()
-            silhouette_scores[n][c] = silhouette_score
+            silhouette_scores[n][c] = result["metrics"]["silhouette_score"]
 
-            metrics_dict_entry = {"n_neighbors": n, "min_cluster_size": c, "silhouette_score": silhouette_score, "unclassified_percentage": cluster_props[-1], "davies_bouldin_index": davies_bouldin_index, "calinski_harabasz_score": calinski_harabasz_score}
             metrics_dict_entry_id = str(n) + "_" + str(c)
-            metrics_dict[metrics_dict_entry_id] = metrics_dict_entry
-
-            print_clustering_result(n, c, cluster_props, metrics_dict_entry)
-
-            palette = get_palette(max(cluster_labels) + 1)
-            if -1 in cluster_labels:
-                palette.insert(0, "#B3B4B5")
-            cmap1 = ListedColormap(palette)
-
-            ax = plt.subplots()[1]
-            scatter = ax.scatter(embedding[:,0], embedding[:,1], c=cluster_labels, cmap=cmap1, s=0.3)
-
-            # Shrink current axis by 20%
-            box = ax.get_position()
-            ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-
-            legend1 = ax.legend(*scatter.legend_elements(),
-                        loc="center left", title="Clusters", bbox_to_anchor=(1, 0.5))
-            ax.add_artist(legend1)
+            metrics_dict[metrics_dict_entry_id] = result["metrics"]
 
-            outfile = '{}/umap_clustering_n{}_c{}.png'.format(outdir_full, n, c)
-            plt.savefig(outfile)
-            plot_file = outfile
+            print_clustering_result(n, c, result["cluster_props"], result["metrics"])
 
             if c not in plot_files:
                 plot_files[c] = dict()
-            plot_files[c][n] = plot_file
+            plot_files[c][n] = result["plot_file"]
 
 
     html = get_html_string(neighbours_list, cluster_size_list, plot_files, all_cluster_props, silhouette_scores)
@@ -303,6 +486,11 @@ if __name__ == "__main__":
     parser.add_argument("--leaf_size", help="leaf_size setting for HDBSCAN (default: 40)", default=40, type=int)
     parser.add_argument("--min_samples", help="min_samples setting for HDBSCAN (default: None)", default=None, type=int)
     parser.add_argument("--selected_scaff_only", help="Optional: name of a scaffold from the input TSV file, to run UMAP+HDBSCAN with that scaffold only. Default: None (all scaffold are used by default)", default=None, type=str)
-    parser.add_argument("tracks", help="File of windowed GDA tracks", type=str)
+    parser.add_argument("--silhouette_sample_size", help="Embeddings with more windows than this get a silhouette score estimated from a random sample of this many windows, with a 95%% confidence interval. 0 calculates the exact silhouette score for all embeddings (default: {})".format(SILHOUETTE_SAMPLE_SIZE), default=SILHOUETTE_SAMPLE_SIZE, type=int)
+    parser.add_argument("--plot_style", help="Style of the UMAP plots: 'density' draws the embedding on a grid of pixels coloured by the clusters of their windows, which is fast for any number of windows, 'scatter' draws a dot for each window (default: density)", default="density", choices=PLOT_STYLES, type=str)
+    parser.add_argument("--jobs", help="Number of n_neighbors values that are processed in parallel, each in its own process (default: 1)", default=1, type=int)
+    parser.add_argument("--embedding_cache_dir", help="Folder for cached UMAP embeddings (default: the hidden .umap_embedding_cache folder in the output dir)", default="", type=str)
+    parser.add_argument("--embedding_cache_size", help="Maximum size of the UMAP embedding cache in MB, least recently used embeddings are removed above this size. 0 disables the cache (default: 2000)", default=2000, type=int)
+    parser.add_argument("tracks", help="File of windowed GDA tracks (merged TSV file or columnar tracks folder made with gda convert_tracks)", type=str)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Stage-level timing and memory measurements of GDA clustering runs.
+The wall time, CPU time and peak resident set size of each stage are written to run_profile.json in the output folder.
+Optionally, each stage is also run under cProfile and the profile of the slowest stage is saved
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import time
+import json
+import resource
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+RUN_PROFILE_FILENAME = 'run_profile.json'
+
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    '''Returns the peak resident set size in MB of this process since it started (or of the largest of its finished child processes, with who=resource.RUSAGE_CHILDREN).
+    ru_maxrss is in kilobytes on Linux'''
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def get_current_rss_mb():
+    '''Returns the current resident set size in MB of this process, or None where /proc/self/statm is not available'''
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * resource.getpagesize() / (1024 * 1024)
+
+
+def get_child_cpu_time():
+    '''Returns the CPU time in seconds used by the finished child processes (e.g. workers of process pools)'''
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_traced_memory_peak():
+    '''Start a new peak of the Python heap traced by tracemalloc. tracemalloc.reset_peak needs Python 3.9, so on older Pythons tracing is restarted instead,
+    which also forgets the blocks allocated before this call: the peak is then the peak of the memory allocated after it'''
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+class RunProfiler():
+    ''' Records the wall time, CPU time and memory use of named stages of a run.
+    The peak RSS of a process is only known since the start of the process, so for each stage the RSS at the end of the stage, the peak RSS of the process so far
+    and the amount by which the stage raised that peak are recorded. A stage that raised the peak by 0 MB stayed below the peak of the earlier stages.
+    If use_cprofile is True, each stage is also run under cProfile and the Python heap peak of each stage is traced with tracemalloc'''
+    def __init__(self, use_cprofile=False):
+        self.use_cprofile = use_cprofile
+        self.stages = list()
+        self.stage_profiles = dict()
+        self.start_time = time.perf_counter()
+        if self.use_cprofile:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        '''Context manager for measuring one stage of the run'''
+        profile = None
+        if self.use_cprofile:
+            reset_traced_memory_peak()
+            profile = cProfile.Profile()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        child_cpu_start = get_child_cpu_time()
+        peak_rss_start = get_peak_rss_mb()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            process_peak_rss = get_peak_rss_mb()
+            stage_stats = {'name': name,
+                           'wall_time_s': time.perf_counter() - wall_start,
+                           'cpu_time_s': time.process_time() - cpu_start,
+                           'child_cpu_time_s': get_child_cpu_time() - child_cpu_start,
+                           'end_rss_mb': get_current_rss_mb(),
+                           'process_peak_rss_mb': process_peak_rss,
+                           'peak_rss_increase_mb': process_peak_rss - peak_rss_start,
+                           'child_process_peak_rss_mb': get_peak_rss_mb(resource.RUSAGE_CHILDREN)}
+            if profile is not None:
+                stage_stats['python_heap_peak_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                self.stage_profiles[name] = profile
+            self.stages.append(stage_stats)
+            sys.stderr.write("Stage {}: wall time {:.1f} s, CPU time {:.1f} s, process peak RSS so far {:.1f} MB (+{:.1f} MB in this stage)\n".format(name, stage_stats['wall_time_s'], stage_stats['cpu_time_s'], stage_stats['process_peak_rss_mb'], stage_stats['peak_rss_increase_mb']))
+
+    def get_slowest_stage(self):
+        '''Returns the name of the stage with the longest wall time, or None if no stages were recorded'''
+        if len(self.stages) == 0:
+            return None
+        return max(self.stages, key=lambda x: x['wall_time_s'])['name']
+
+    def write(self, outdir):
+        '''Write run_profile.json to outdir. With cProfile enabled, the profile of the slowest stage is also written as a pstats file'''
+        run_profile = {'total_wall_time_s': time.perf_counter() - self.start_time, 'stages': self.stages}
+        slowest_stage = self.get_slowest_stage()
+        if slowest_stage in self.stage_profiles:
+            profile_filename = 'run_profile_' + slowest_stage.replace(' ', '_') + '.prof'
+            self.stage_profiles[slowest_stage].dump_stats(outdir + '/' + profile_filename)
+            run_profile['cprofile_stage'] = slowest_stage
+            run_profile['cprofile_file'] = profile_filename
+        with open(outdir + '/' + RUN_PROFILE_FILENAME, 'w') as f:
+            f.write(json.dumps(run_profile, indent=1))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Script for projecting the windows of new genome assemblies into an existing GDA clustering.
+The scaler, UMAP reducer and HDBSCAN clusterer fitted by gda_clustering.py --save_models are used to embed and label the new windows,
+without refitting UMAP and HDBSCAN on all genomes
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import os
+import argparse
+import hdbscan
+
+from gda_clustering import load_models, read_tracks, write_embedding, write_cluster_gff, write_all_species_outputs, check_umap_version, get_window_numbers
+
+
+def get_projection_features(data, feature_columns, tracks_file):
+    '''Returns the feature values of the new windows in the column order that the models were fitted with'''
+    missing_columns = [f for f in feature_columns if f not in data.columns]
+    if len(missing_columns) > 0:
+        sys.stderr.write("The following feature column(s) that the clustering was fitted with are missing from {}: {}\n".format(tracks_file, ", ".join(missing_columns)))
+        sys.exit(1)
+    extra_columns = [f for f in data.columns if f not in feature_columns and f not in ('species', 'start', 'end', 'chromosome')]
+    if len(extra_columns) > 0:
+        sys.stderr.write("Warning: the following column(s) from the file {} will not be used, as they were not used for fitting the clustering: {}\n".format(tracks_file, ", ".join(extra_columns)))
+    return data[feature_columns]
+
+
+def main(models_file, cluster_position_histogram_window_numbers, outdir, tracks_file, workers, bgzip):
+    check_umap_version()
+
+    # Set up output directory
+    if not os.path.exists(outdir):
+        sys.stderr.write("Creating directory: {}\n".format(outdir))
+        os.mkdir(outdir)
+    else:
+        sys.stderr.write("{} already exists\n".format(outdir))
+
+    models = load_models(models_file)
+    data = read_tracks(tracks_file)
+    data_to_project = get_projection_features(data, models['feature_columns'], tracks_file)
+
+    # Embed the new windows with the fitted scaler and UMAP reducer
+    sys.stderr.write("Projecting windows into the UMAP embedding\n")
+    scaled_data = models['scaler'].transform(data_to_project)
+    embedding = models['reducer'].transform(scaled_data)
+
+    # Assign the new windows to the existing HDBSCAN clusters
+    sys.stderr.write("Assigning windows to HDBSCAN clusters\n")
+    cluster_labels = hdbscan.approximate_predict(models['clusterer'], embedding)[0]
+    cluster_colours = models['cluster_colours']
+
+    data['cluster'] = cluster_labels
+
+    outfile = "umap_clustering.csv"
+    write_embedding(embedding, cluster_labels, data['species'].tolist(), outfile, outdir, cluster_colours)
+    write_cluster_gff(data, outdir, compress=bgzip)
+
+    failed_species = write_all_species_outputs(data, cluster_colours, outdir, cluster_position_histogram_window_numbers, workers=workers, compress=bgzip)
+    if len(failed_species) > 0:
+        sys.stderr.write("The outputs of the following species could not be written: {}\n".format(", ".join(sorted(failed_species))))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-w", "--cluster_position_histogram_window_number", help="Cluster position histogram window number. Several comma separated window numbers (e.g. 20,50,100) can be given, for choosing the resolution of the cluster position line charts in the Shiny app: the histograms with the first window number are written to clusterpos.json and the others to clusterpos_w<window number>.json [20]", default="20", type=str)
+    parser.add_argument("--workers", help="Number of worker processes for writing the outputs of each species (default: 1)", default=1, type=int)
+    parser.add_argument("--bgzip", help="Write clusters.bed and clusters.gff files as bgzip-compressed files (clusters.bed.gz and clusters.gff.gz)", action="store_true")
+    parser.add_argument("-d", "--directory", help="Output dir [gda_projected_out]", default="gda_projected_out", type=str)
+    parser.add_argument("models", help="gda_models.pkl file from a gda_clustering.py --save_models run", type=str)
+    parser.add_argument("tracks", help="File of windowed GDA tracks of the new assemblies", type=str)
+    args = parser.parse_args()
+    main(args.models, get_window_numbers(args.cluster_position_histogram_window_number), args.directory, args.tracks, args.workers, args.bgzip)
@@ -42,15 +42,24 @@ def main(in_folder, selected_species):
         sys.stderr.write("{} does not appear to be a directory\n".format(in_folder))
         sys.exit(1)
     in_folder_files = os.listdir(in_folder)
-    expected_files = ("cluster_heatmap.csv", "feathist.json", "genomeprops.csv", "umap_clustering.csv", "clusters.gff", "feattable.csv")
+    expected_files = ("cluster_heatmap.csv", "genomeprops.csv", "umap_clustering.csv", "feattable.csv")
     for expected_file in expected_files:
         if expected_file not in in_folder_files:
             sys.stderr.write("File {} was not found. The user-provided input directory ({}) does not appear to be a gda_out directory\n".format(expected_file, in_folder))
             sys.exit(1)
+    # clusters.gff is bgzip-compressed (clusters.gff.gz) in the output of gda clustering with the --bgzip option
+    if "clusters.gff" not in in_folder_files and "clusters.gff.gz" not in in_folder_files:
+        sys.stderr.write("File clusters.gff was not found. The user-provided input directory ({}) does not appear to be a gda_out directory\n".format(in_folder))
+        sys.exit(1)
+    # Feature histograms are in feathist_binned.json, or only in feathist.json in the output of older versions of GDA
+    if "feathist_binned.json" not in in_folder_files and "feathist.json" not in in_folder_files:
+        sys.stderr.write("File feathist_binned.json was not found. The user-provided input directory ({}) does not appear to be a gda_out directory\n".format(in_folder))
+        sys.exit(1)
     current_script_dir = os.path.dirname(os.path.realpath(__file__))
     subfolders = [f.path for f in os.scandir(in_folder) if f.is_dir()]
     subfolders = [os.path.basename(os.path.normpath(n)) for n in subfolders]
-    subfolders = [n for n in subfolders if n != "parameter_selection"]
+    # Hidden folders (e.g. the UMAP embedding cache) and the parameter selection results are not species folders
+    subfolders = [n for n in subfolders if n != "parameter_selection" and n != "umap_embedding_cache" and not n.startswith(".")]
     if selected_species == "":
         if len(subfolders) == 1:
             selected_species = subfolders[0]
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Per-species analyses of GDA clusters: cluster junction Fisher test, cluster position histograms, chromosome cluster composition
+and Circos data. These are computed from the data frame of clustered windows, without reading back the clusters.bed file
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import os
+from collections import OrderedDict
+
+from BedFile import BedFile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'feature_extraction'))
+from cluster_junctions_fisher_test import get_cluster_junctions_table
+
+
+def get_clusters_dict(species_data):
+    '''Returns an OrderedDict where keys are chromosome names and values are lists of the clusters of the windows of the chromosome, in the order of the data frame rows'''
+    clusters_dict = OrderedDict()
+    for (chromosome, cluster) in zip(species_data['chromosome'].astype(str), species_data['cluster']):
+        if chromosome not in clusters_dict:
+            clusters_dict[chromosome] = list()
+        clusters_dict[chromosome].append(int(cluster))
+    return clusters_dict
+
+
+def get_species_analytics(species_data, cluster_colours, cluster_position_histogram_window_numbers):
+    '''Run the per-species analyses on the clustered windows of one species (data frame with chromosome, start, end and cluster columns).
+    Returns a dict with the cluster junction Fisher test table, cluster position histograms (a dict with the histograms of each window number),
+    chromosome cluster composition and Circos data'''
+    bed_data = BedFile.from_clusters(species_data, cluster_colours)
+    analytics = dict()
+    analytics['cluster_junctions'] = get_cluster_junctions_table(get_clusters_dict(species_data))
+    analytics['cluster_positions'] = bed_data.multi_cluster_histograms(cluster_position_histogram_window_numbers)
+    analytics['chromosome_composition'] = bed_data.chromosome_composition()
+    analytics['circos'] = bed_data.circos_json()
+    return analytics
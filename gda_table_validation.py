@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Validation checks for concatenating the merged tracks tables of multiple genomes.
+The checks collect all problems that they find into a ValidationReport instead of exiting at the first problem, so that all problems
+of a set of input tables can be fixed at once. Window sizes are found from the differences between consecutive start coordinates
+within each chromosome, and values shared between tables are found with set intersections, without loops over the windows
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import json
+import numpy as np
+
+REQUIRED_COLUMNS = ("window", "start", "end", "species", "chromosome")
+# Columns whose values have to be different in each input table
+UNIQUE_VALUE_COLUMNS = ("species", "chromosome", "window")
+# Maximum number of example values listed in the message of a problem
+MAX_EXAMPLE_VALUES = 10
+
+
+class ValidationReport():
+    ''' Problems found by the validation checks. Each problem is a dict with the name of the check, its severity ('error' or 'warning'),
+    the input file that it concerns (None for problems between files), a message and optional details for the JSON report '''
+    def __init__(self):
+        self.problems = list()
+
+    def add(self, check, message, tsv_file=None, severity='error', details=None):
+        '''Add a problem to the report'''
+        self.problems.append({'check': check, 'severity': severity, 'file': tsv_file, 'message': message, 'details': details})
+
+    def has_errors(self):
+        '''Returns True if the report has problems with the severity 'error', which prevent the tables from being concatenated'''
+        return any(x['severity'] == 'error' for x in self.problems)
+
+    def write(self, stream=sys.stderr):
+        '''Write the messages of all problems to a text stream, warnings first'''
+        for severity in ('warning', 'error'):
+            for problem in self.problems:
+                if problem['severity'] == severity:
+                    stream.write("{}: {}\n".format(severity.capitalize(), problem['message']))
+
+    def write_json(self, outfile):
+        '''Write the report to a JSON file'''
+        report = {'valid': not self.has_errors(), 'n_errors': sum(x['severity'] == 'error' for x in self.problems),
+                  'n_warnings': sum(x['severity'] == 'warning' for x in self.problems), 'problems': self.problems}
+        with open(outfile, 'w') as f:
+            f.write(json.dumps(report, indent=1))
+
+
+def check_duplicate_files(report, tsv_files):
+    '''Report input files that are given more than once. Returns the input files without repeats'''
+    unique_files = list(dict.fromkeys(tsv_files))
+    for tsv_file in unique_files:
+        if tsv_files.count(tsv_file) > 1:
+            report.add('duplicate_files', "The input file {} appears in the input more than once".format(tsv_file), tsv_file)
+    return unique_files
+
+
+def check_required_columns(report, tsv_file, columns):
+    '''Report the required columns that are missing from the columns of an input file. Returns True if none are missing'''
+    missing_columns = [x for x in REQUIRED_COLUMNS if x not in columns]
+    for required_col in missing_columns:
+        report.add('required_columns', "Required column with the name '{}' was not found in the input file {}".format(required_col, tsv_file), tsv_file)
+    return len(missing_columns) == 0
+
+
+def check_noncommon_columns(report, columns_dict):
+    '''Report, as warnings, the columns of each input file that do not occur in the other input files.
+    These columns will be left out from the output table. Returns the shared columns, in the order of the first input file'''
+    common_cols = set.intersection(*(set(columns) for columns in columns_dict.values()))
+    for tsv_file in columns_dict:
+        noncommon_cols = [n for n in columns_dict[tsv_file] if n not in common_cols]
+        if len(noncommon_cols) > 0:
+            report.add('noncommon_columns', "the following column(s) from the file {} will not be used, as they do not occur in the other TSV file(s): {}".format(tsv_file, ", ".join(noncommon_cols)),
+                       tsv_file, severity='warning', details={'columns': noncommon_cols})
+    return [n for n in list(columns_dict.values())[0] if n in common_cols]
+
+
+def get_window_steps(chromosomes, start_coords, previous_window=None):
+    '''Returns the set of differences between the start coordinates of consecutive windows of the same chromosome, ignoring differences that are not positive,
+    and the chromosome and start coordinate of the last window. For the windows of a table read in chunks, the last window of the previous chunk
+    is passed as previous_window, so that the difference between the chunks is included'''
+    chromosomes = np.asarray(chromosomes, dtype=object)
+    start_coords = np.asarray(start_coords)
+    if len(start_coords) == 0:
+        return (set(), previous_window)
+    if previous_window is not None:
+        chromosomes = np.concatenate([[previous_window[0]], chromosomes])
+        start_coords = np.concatenate([[previous_window[1]], start_coords])
+    diffs = np.diff(start_coords)
+    is_step = (chromosomes[1:] == chromosomes[:-1]) & (diffs > 0)
+    return (set(diffs[is_step].tolist()), (chromosomes[-1], start_coords[-1].item()))
+
+
+def check_window_sizes(report, window_steps_dict):
+    '''Report input files with more than one window step size, and input files with different window sizes.
+    window_steps_dict has the set of window steps (see get_window_steps) of each input file.
+    Files with only one window per chromosome have no window steps, so their window size is not checked. Returns a dict of the window size of each file'''
+    window_sizes = dict()
+    for tsv_file in window_steps_dict:
+        window_steps = sorted(window_steps_dict[tsv_file])
+        if len(window_steps) > 1:
+            report.add('window_size', "More than one window step size ({}) was found in the file {}".format(",".join(map(str, window_steps)), tsv_file), tsv_file,
+                       details={'window_steps': window_steps})
+        elif len(window_steps) == 1:
+            window_sizes[tsv_file] = window_steps[0]
+    if len(set(window_sizes.values())) > 1:
+        report.add('window_size', "The input TSV files appear to have different window sizes: {}".format(", ".join("{}: window size {} bp".format(tsv_file, window_sizes[tsv_file]) for tsv_file in window_sizes)),
+                   details={'window_sizes': window_sizes})
+    return window_sizes
+
+
+def check_duplicate_entries(report, entries_dict):
+    '''The values in the columns 'species', 'chromosome' and 'window' have to be different in each input file.
+    Report the values of each of these columns that occur in more than one input file, with up to MAX_EXAMPLE_VALUES examples in the message.
+    entries_dict has a dict of the sets of the values of each of these columns of each input file. Returns the number of shared values of each column'''
+    n_duplicates = dict()
+    for col_label in UNIQUE_VALUE_COLUMNS:
+        seen_values = set()
+        duplicated_values = set()
+        for tsv_file in entries_dict:
+            file_values = entries_dict[tsv_file][col_label]
+            duplicated_values.update(seen_values.intersection(file_values))
+            seen_values.update(file_values)
+        n_duplicates[col_label] = len(duplicated_values)
+        if len(duplicated_values) == 0:
+            continue
+        example_values = sorted(duplicated_values, key=str)[:MAX_EXAMPLE_VALUES]
+        example_files = {str(v): [tsv_file for tsv_file in entries_dict if v in entries_dict[tsv_file][col_label]] for v in example_values}
+        report.add('duplicate_entries', "{} value(s) appear in the '{}' column in more than one input file: {}{}".format(len(duplicated_values), col_label,
+                   "; ".join("{} ({})".format(v, ", ".join(example_files[v])) for v in example_files), ", ..." if len(duplicated_values) > MAX_EXAMPLE_VALUES else ""),
+                   details={'column': col_label, 'n_values': len(duplicated_values), 'examples': example_files})
+    return n_duplicates
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Reading and writing of GDA merged tracks tables.
+Besides the merged TSV format, tables can be stored in a binary columnar format: a folder with one .npy file per column
+and a metadata.json sidecar. Only the requested columns of this format are read, and leaving out columns is what saves memory:
+the columns that are read are copied from their memory-mapped files into the data frame.
+When run as a script, converts a tracks table between the TSV and the columnar format
+"""
+# MIT License
+#
+# Copyright (c) 2020-2021 Genome Research Ltd.
+#
+# Authors: Adam Reid (ar11@sanger.ac.uk), Eerik Aunin (ea10@sanger.ac.uk)
+#
+# This file is a part of the Genome Decomposition Analysis (GDA) pipeline.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+COLUMNAR_FORMAT_NAME = 'gda_columnar_tracks'
+COLUMNAR_FORMAT_VERSION = 1
+METADATA_FILENAME = 'metadata.json'
+# Text columns that are stored as integer codes plus a list of categories
+CATEGORICAL_COLUMNS = ('species', 'chromosome')
+# Window coordinates are kept as integers when the other columns are read with compact dtypes
+COORDINATE_COLUMNS = ('start', 'end')
+
+
+def is_columnar_tracks(path):
+    '''Returns True if the path is a folder in the columnar tracks format'''
+    return os.path.isdir(path) and os.path.isfile(path + '/' + METADATA_FILENAME)
+
+
+def write_tracks_columnar(data, out_path):
+    '''Write a tracks data frame (with window names as the index) to a folder in the columnar tracks format'''
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+    columns_metadata = list()
+    np.save(out_path + '/index.npy', data.index.to_numpy(dtype=str))
+    for i, col in enumerate(data.columns):
+        col_file = 'col_{}.npy'.format(i)
+        col_metadata = {'name': col, 'file': col_file}
+        if col in CATEGORICAL_COLUMNS:
+            (codes, categories) = pd.factorize(data[col].astype(str), sort=True)
+            np.save(out_path + '/' + col_file, codes.astype(np.int32))
+            col_metadata['categories'] = categories.tolist()
+        else:
+            np.save(out_path + '/' + col_file, data[col].to_numpy())
+        columns_metadata.append(col_metadata)
+    metadata = {'format': COLUMNAR_FORMAT_NAME, 'version': COLUMNAR_FORMAT_VERSION, 'n_rows': len(data.index), 'index_name': data.index.name, 'columns': columns_metadata}
+    with open(out_path + '/' + METADATA_FILENAME, 'w') as f:
+        f.write(json.dumps(metadata, indent=1))
+
+
+def load_columnar_metadata(path):
+    '''Load and check the metadata of a folder in the columnar tracks format'''
+    with open(path + '/' + METADATA_FILENAME) as f:
+        metadata = json.load(f)
+    if metadata.get('format') != COLUMNAR_FORMAT_NAME or metadata.get('version') != COLUMNAR_FORMAT_VERSION:
+        sys.stderr.write("{} is not a supported columnar tracks folder\n".format(path))
+        sys.exit(1)
+    return metadata
+
+
+def read_tracks_columnar(path, columns=None, compact=False):
+    '''Read a tracks data frame from a folder in the columnar tracks format.
+    If columns is given, only those columns are read. Each column is memory-mapped from its .npy file and copied once into the data frame,
+    so the data frame holds all of the read columns in memory, but the file contents are not read into a second temporary array.
+    If compact is True, feature values are read as float32 and species and chromosome as categoricals'''
+    metadata = load_columnar_metadata(path)
+    columns_metadata = metadata['columns']
+    if columns is not None:
+        available_columns = [x['name'] for x in columns_metadata]
+        missing_columns = [x for x in columns if x not in available_columns]
+        if len(missing_columns) > 0:
+            sys.stderr.write("Column(s) not found in {}: {}\n".format(path, ", ".join(missing_columns)))
+            sys.exit(1)
+        columns_metadata = [x for x in columns_metadata if x['name'] in columns]
+    col_dict = dict()
+    for col_metadata in columns_metadata:
+        col_values = np.load(path + '/' + col_metadata['file'], mmap_mode='r')
+        if 'categories' in col_metadata:
+            if compact:
+                col_values = pd.Categorical.from_codes(col_values, categories=col_metadata['categories'])
+            else:
+                col_values = np.asarray(col_metadata['categories'], dtype=object)[col_values]
+        elif compact and col_metadata['name'] not in COORDINATE_COLUMNS and col_values.dtype.kind in 'iuf':
+            col_values = col_values.astype(np.float32)
+        col_dict[col_metadata['name']] = col_values
+    index = pd.Index(np.load(path + '/index.npy').astype(object), name=metadata['index_name'])
+    return pd.DataFrame(col_dict, index=index)
+
+
+def get_compact_dtypes(header):
+    '''Returns a dict of column dtypes for reading a merged TSV file with float32 feature values and categorical species and chromosome columns'''
+    dtypes = dict()
+    for col in header[1:]:
+        if col in CATEGORICAL_COLUMNS:
+            dtypes[col] = 'category'
+        elif col not in COORDINATE_COLUMNS:
+            dtypes[col] = np.float32
+    return dtypes
+
+
+def read_tracks_table(path, columns=None, compact=False):
+    '''Read a tracks table (merged TSV file or columnar tracks folder) with window names as the index.
+    If columns is given, only those columns (and the index) are read.
+    If compact is True, feature values are read as float32 and species and chromosome as categoricals to reduce memory use'''
+    if is_columnar_tracks(path):
+        return read_tracks_columnar(path, columns, compact)
+    header = pd.read_csv(path, sep='\t', nrows=0).columns.tolist()
+    usecols = None
+    if columns is not None:
+        usecols = [header[0]] + [x for x in header[1:] if x in columns]
+    dtypes = None
+    if compact:
+        dtypes = get_compact_dtypes(header)
+    return pd.read_csv(path, sep='\t', index_col=0, usecols=usecols, dtype=dtypes)
+
+
+def main(in_path, out_path):
+    if is_columnar_tracks(in_path):
+        data = read_tracks_columnar(in_path)
+        data.to_csv(out_path, sep='\t', index=True, header=True)
+    elif os.path.isfile(in_path):
+        data = pd.read_csv(in_path, sep='\t', index_col=0)
+        write_tracks_columnar(data, out_path)
+    else:
+        sys.stderr.write("Input file {} was not found\n".format(in_path))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("in_path", type=str, help="Path to a merged TSV file or a columnar tracks folder")
+    parser.add_argument("out_path", type=str, help="Output path. If the input is a TSV file, a columnar tracks folder is written to this path, otherwise a TSV file is written")
+    args = parser.parse_args()
+    main(args.in_path, args.out_path)